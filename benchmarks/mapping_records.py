@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SYNC
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+"""Compares the soup records with the records of the mapping table.
+
+For each backend the given number of rows is written to a new FileStorage
+and read back from a fresh connection. The database size, the pickle size
+per row, the time to read all the rows and the memory used to do it are
+reported. The soup catalog is not included, so soup figures are a lower
+bound, while the mapping table figures include its indexes.
+
+Run it with the Python of the instance, e.g.:
+
+    bin/zopepy benchmarks/mapping_records.py --rows 1000000
+"""
+
+import argparse
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import transaction
+from BTrees.IOBTree import IOBTree
+from ZODB import DB
+from ZODB.FileStorage import FileStorage
+from souper.soup import Record
+
+from senaite.sync.mappingstore import MappingStorage
+from senaite.sync.souphandler import COLUMNS
+from senaite.sync.souphandler import Row
+from senaite.sync.souphandler import record_to_row
+
+SAVEPOINT_INTERVAL = 10000
+
+
+def make_values(i):
+    """ Column values of the i-th row, with realistic sizes
+    """
+    return ("%032x" % i,
+            "%032x" % (i + 10 ** 9),
+            "/senaite/clients/client-{}/W-{:07d}".format(i / 1000, i),
+            "/senaite/clients/client-{}/W-{:07d}".format(i / 1000, i),
+            "AnalysisRequest",
+            "1",
+            "2018-05-14T10:21:{:02d}+02:00".format(i % 60))
+
+
+def write_soup_records(root, rows):
+    data = root["records"] = IOBTree()
+    for i in xrange(rows):
+        record = Record()
+        record.intid = i
+        for column, value in zip(COLUMNS, make_values(i)):
+            record.attrs[column] = value
+        data[i] = record
+        if i % SAVEPOINT_INTERVAL == 0:
+            transaction.savepoint(True)
+
+
+def read_soup_records(root):
+    return sum(1 for record in root["records"].values()
+               if record_to_row(record))
+
+
+def write_mapping_records(root, rows):
+    mapping = root["records"] = MappingStorage()
+    for i in xrange(rows):
+        mapping.add(make_values(i), rec_id=i)
+        if i % SAVEPOINT_INTERVAL == 0:
+            transaction.savepoint(True)
+
+
+def read_mapping_records(root):
+    return sum(1 for rec_id, values in root["records"].data.iteritems()
+               if Row(rec_id, values))
+
+
+BACKENDS = (
+    ("soup", write_soup_records, read_soup_records),
+    ("mapping", write_mapping_records, read_mapping_records),
+)
+
+
+def get_max_rss():
+    """ Maximum resident set size of the process in KB
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def write_database(path, write, rows):
+    db = DB(FileStorage(path))
+    conn = db.open()
+    write(conn.root(), rows)
+    transaction.commit()
+    conn.close()
+    db.pack()
+    db.close()
+
+
+def read_database(path, read):
+    db = DB(FileStorage(path, read_only=True))
+    conn = db.open()
+    start = time.time()
+    read(conn.root())
+    elapsed = time.time() - start
+    conn.close()
+    db.close()
+    return elapsed
+
+
+def in_subprocess(func, *args):
+    """ Runs the function in a forked process, so the memory figures of each
+    step don't depend on the previous ones
+    """
+    pid = os.fork()
+    if pid == 0:
+        func(*args)
+        sys.stdout.flush()
+        os._exit(0)
+    os.waitpid(pid, 0)
+
+
+def run_backend(name, write, read, rows, directory):
+    path = os.path.join(directory, "{}.fs".format(name))
+    in_subprocess(write_database, path, write, rows)
+    size = os.path.getsize(path)
+
+    def report():
+        rss = get_max_rss()
+        elapsed = read_database(path, read)
+        rss = get_max_rss() - rss
+        print("{:<8} {:>10.1f} MB {:>8.1f} B/row {:>8.2f} s {:>10} KB".format(
+              name, size / 1024.0 / 1024.0, float(size) / rows, elapsed, rss))
+
+    in_subprocess(report)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000000,
+                        help="number of rows of the domain")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="senaite.sync-benchmark-")
+    print("{:<8} {:>13} {:>14} {:>10} {:>13}".format(
+          "backend", "database", "size", "read", "memory"))
+    sys.stdout.flush()
+    try:
+        for name, write, read in BACKENDS:
+            run_backend(name, write, read, args.rows, directory)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -55,5 +55,8 @@ setup(
       # -*- Entry points: -*-
       [z3c.autoinclude.plugin]
       target = plone
+
+      [zopectl.command]
+      sync = senaite.sync.run:main
       """,
 )
@@ -8,10 +8,13 @@ from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
 from plone import protect
 from senaite import api
 from senaite.sync import _
+from senaite.sync import jobs
 from senaite.sync import utils
 from senaite.sync.browser.interfaces import ISync
 from senaite.sync.browser.views import Sync
 from senaite.sync.fetchstep import FetchStep
+from senaite.sync.importstep import DEFAULT_IMPORT_CONCURRENCY
+from senaite.sync.syncstep import DEFAULT_FETCH_CONCURRENCY
 from zope.interface import implements
 
 SYNC_STORAGE = "senaite.sync"
@@ -57,6 +60,11 @@ class Add(Sync):
             self.add_status_message(message, "error")
             return self.template()
 
+        # The credentials and configuration of a domain with a pending job
+        # must not change, nor must a second fetch be queued
+        if self.has_active_job(self.domain_name):
+            return self.template()
+
         self.auto_sync = (form.get("auto_sync") == 'on')
 
         self.import_settings = (form.get("import_settings") == 'on')
@@ -77,6 +85,28 @@ class Add(Sync):
         self.prefixable_types = utils.filter_content_types(
                                     form.get("prefixable_types"))
 
+        self.cursor_pagination = (form.get("cursor_pagination") == 'on')
+        self.fetch_concurrency = utils.to_int(
+            form.get("fetch_concurrency"), DEFAULT_FETCH_CONCURRENCY)
+        if self.fetch_concurrency < 1:
+            message = _("Fetch Concurrency must be a positive number")
+            self.add_status_message(message, "error")
+            return self.template()
+
+        self.import_concurrency = utils.to_int(
+            form.get("import_concurrency"), DEFAULT_IMPORT_CONCURRENCY)
+        if self.import_concurrency < 0:
+            message = _("Import Concurrency must not be negative")
+            self.add_status_message(message, "error")
+            return self.template()
+
+        self.max_attachment_size = utils.to_int(
+            form.get("max_attachment_size"), 0)
+        if self.max_attachment_size < 0:
+            message = _("Max. Attachment Size must not be negative")
+            self.add_status_message(message, "error")
+            return self.template()
+
         # Prefix Validation
         if not self.validate_prefix():
             return self.template()
@@ -100,12 +130,19 @@ class Add(Sync):
             read_only_types=self.read_only_types,
             update_only_types=self.update_only_types,
             prefixable_types=self.prefixable_types,
+            cursor_pagination=self.cursor_pagination,
+            fetch_concurrency=self.fetch_concurrency,
+            import_concurrency=self.import_concurrency,
+            max_attachment_size=self.max_attachment_size,
         )
 
         fs = FetchStep(credentials, config)
         verified, message = fs.verify()
         if verified:
-            fs.run()
+            # Data is fetched in the background, see the 'sync_jobs' view
+            job_id = jobs.enqueue(self.portal, self.domain_name, "fetch")
+            message = _("Fetch of {} queued as job {}".format(
+                        self.domain_name, job_id))
             self.add_status_message(message, "info")
         else:
             self.add_status_message(message, "error")
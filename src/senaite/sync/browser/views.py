@@ -12,10 +12,12 @@ from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
 from plone import protect
 from senaite import api
 from senaite.sync import _
+from senaite.sync import jobs
 from senaite.sync.browser.interfaces import ISync
-from senaite.sync.importstep import ImportStep
+from senaite.sync.mappingstore import MAPPING
+from senaite.sync.mappingstore import MappingStorage
 from senaite.sync.souphandler import delete_soup
-from senaite.sync.updatestep import UpdateStep
+from senaite.sync.uidlist import UIDList
 from zope.annotation.interfaces import IAnnotations
 from zope.interface import implements
 
@@ -56,6 +58,10 @@ class Sync(BrowserView):
 
         domain_name = form.get("domain_name", None)
 
+        # Jobs of the domain must not find its storage changed or deleted
+        if self.has_active_job(domain_name):
+            return self.template()
+
         # Handle "Clear this Storage" action
         if form.get("clear_storage", False):
             del self.storage[domain_name]
@@ -66,12 +72,17 @@ class Sync(BrowserView):
 
         # Get the necessary data for the domain
         storage = self.get_storage(domain_name)
-        credentials = storage["credentials"]
-        config = storage["configuration"]
+
+        # Steps run in the background, see the 'sync_jobs' view
+        options = dict()
+
+        # Handle "Resume Fetch" action
+        if form.get("resume_fetch", False):
+            step = "resume_fetch"
 
         # Handle "Import" action
-        if form.get("import", False):
-            step = ImportStep(credentials, config)
+        elif form.get("import", False):
+            step = "import"
 
         # Handle "Update" action
         else:
@@ -90,11 +101,31 @@ class Sync(BrowserView):
                     self.add_status_message(message, "error")
                     return self.template()
 
-            step = UpdateStep(credentials, config, fetch_time)
+            step = "update"
+            options["fetch_time"] = fetch_time
 
-        step.run()
+        job_id = jobs.enqueue(self.portal, domain_name, step, **options)
+        message = _("Job {} queued: {} of {}".format(job_id, step,
+                                                     domain_name))
+        self.add_status_message(message, "info")
         return self.template()
 
+    def has_active_job(self, domain_name):
+        """
+        Checks if a job of the domain is queued or running, and tells the
+        user to wait until it is finished if so.
+        :param domain_name: name of the domain
+        :return: True or False
+        """
+        active_job = jobs.get_active_job(self.portal, domain_name)
+        if active_job is None:
+            return False
+        message = _("Job {} of {} is {} already, please wait until it is "
+                    "finished".format(active_job["id"], domain_name,
+                                      active_job["state"]))
+        self.add_status_message(message, "warning")
+        return True
+
     def get_storage_config(self, domain_name, config_name, default = None):
         """ Get the advanced configuration setting for a given domain
         :param config_name: advanced configuration section name
@@ -125,7 +156,8 @@ class Sync(BrowserView):
             self.storage[domain]["credentials"] = OOBTree()
             self.storage[domain]["registry"] = OOBTree()
             self.storage[domain]["settings"] = OOBTree()
-            self.storage[domain]["ordered_uids"] = []
+            self.storage[domain]["ordered_uids"] = UIDList()
+            self.storage[domain][MAPPING] = MappingStorage()
             self.storage[domain]["configuration"] = OOBTree()
         return self.storage[domain]
 
@@ -141,6 +173,34 @@ class Sync(BrowserView):
         return annotation[SYNC_STORAGE]
 
 
+class JobsView(BrowserView):
+    """ A view to report the state and the progress of the sync jobs.
+    """
+
+    template = ViewPageTemplateFile("templates/jobs.pt")
+
+    def __call__(self):
+        self.portal = api.get_portal()
+        self.request.set('disable_plone.rightcolumn', 1)
+        self.request.set('disable_border', 1)
+        return self.template()
+
+    def get_jobs(self, limit=50):
+        """ Get the status of the latest jobs, newest first
+        """
+        records = jobs.get_jobs(self.portal)
+        job_ids = list(records.keys())[-limit:]
+        return [jobs.get_job_info(self.portal, records[job_id])
+                for job_id in reversed(job_ids)]
+
+    def format_date(self, date):
+        """ Format DateTime and datetime objects alike
+        """
+        if not date:
+            return "-"
+        return date.strftime("%Y-%m-%d %H:%M:%S")
+
+
 class ContentTypesView:
     """ A view to list all the Content Types existing on the portal.
     """
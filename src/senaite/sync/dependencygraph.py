@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SYNC
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+from collections import OrderedDict
+
+
+class DependencyGraph(object):
+    """
+    A directed graph of objects (by their remote UIDs) and the objects they
+    depend on, e.g. because they reference them.
+    """
+
+    def __init__(self):
+        # Keeps the order in which nodes were added, so results are
+        # deterministic
+        self._dependencies = OrderedDict()
+
+    def __contains__(self, node):
+        return node in self._dependencies
+
+    def __len__(self):
+        return len(self._dependencies)
+
+    def __iter__(self):
+        return iter(self._dependencies)
+
+    def add_node(self, node):
+        """
+        Adds a node without dependencies, if it is not in the graph yet.
+        :param node: remote UID of the object
+        """
+        self._dependencies.setdefault(node, [])
+
+    def add_dependency(self, node, dependency):
+        """
+        Records that the node depends on another one. Both are added to the
+        graph if necessary.
+        :param node: remote UID of the dependent object
+        :param dependency: remote UID of the object it depends on
+        """
+        self.add_node(node)
+        self.add_node(dependency)
+        dependencies = self._dependencies[node]
+        if dependency not in dependencies:
+            dependencies.append(dependency)
+
+    def get_dependencies(self, node):
+        """
+        :param node: remote UID of the object
+        :return: list of the nodes the given one depends on
+        """
+        return list(self._dependencies.get(node, []))
+
+    def get_import_order(self):
+        """
+        Splits the graph into strongly connected components (Tarjan's
+        algorithm, without recursion) in an order where each component comes
+        after all the components it depends on. Components with more than one
+        node are the cycles of the graph.
+        :return: list of components, each one a list of nodes
+        """
+        index = {}
+        lowlink = {}
+        stack = []
+        on_stack = set()
+        components = []
+
+        def visit(node):
+            index[node] = lowlink[node] = len(index)
+            stack.append(node)
+            on_stack.add(node)
+            return node, iter(self._dependencies[node])
+
+        for root in self._dependencies:
+            if root in index:
+                continue
+            work = [visit(root)]
+            while work:
+                node, dependencies = work[-1]
+                for dependency in dependencies:
+                    if dependency not in index:
+                        work.append(visit(dependency))
+                        break
+                    if dependency in on_stack:
+                        lowlink[node] = min(lowlink[node], index[dependency])
+                else:
+                    # All the dependencies of the node have been visited
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[node])
+                    if lowlink[node] != index[node]:
+                        continue
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(list(reversed(component)))
+        return components
@@ -0,0 +1,420 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SYNC
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import threading
+import urlparse
+from multiprocessing.pool import ThreadPool
+
+from senaite.sync import logger
+from senaite.sync import utils
+
+# Number of threads downloading files
+DEFAULT_DOWNLOAD_CONCURRENCY = 4
+# Maximum number of files downloaded from the same host at once
+DEFAULT_DOWNLOADS_PER_HOST = 2
+# Size of the chunks files are downloaded in
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Maximum size of the cache in bytes. The least recently used files are
+# removed beyond it
+DEFAULT_CACHE_SIZE = 2 * 1024 * 1024 * 1024
+# Names of the cached files and index entries, as opposed to partial
+# downloads and copies
+CACHE_FILE_NAME = re.compile(r"^[0-9a-f]{40}$")
+
+
+def get_default_cache_dir(domain_name):
+    """
+    Get the directory where the files of the domain are cached. It is placed
+    in the 'var' directory of the instance, so files are kept between runs.
+    :param domain_name: name of the synchronization domain
+    :return: path of the directory
+    """
+    base = None
+    try:
+        from App.config import getConfiguration
+        base = getConfiguration().clienthome
+    except Exception:
+        pass
+    base = base or tempfile.gettempdir()
+    return os.path.join(base, "senaite.sync", "downloads", domain_name)
+
+
+class Downloader(object):
+    """
+    Downloads files in background threads into a local content addressed
+    cache. Files are stored by the SHA-1 of their content, and two indexes
+    point to them:
+
+    - download url and version: the version is given by the caller, e.g. the
+      modification date of the object, or taken from the ETag or
+      Last-Modified headers. Files found this way are taken from the cache
+      without any request.
+    - size and checksum: taken from the Digest or Content-MD5 headers of the
+      HEAD response, so the same file served under the download urls of
+      several objects is only downloaded once. Without checksum headers, the
+      file is downloaded but still stored only once.
+
+    The least recently used files are removed once the cache grows beyond
+    its maximum size.
+    """
+
+    def __init__(self, session_factory, cache_dir,
+                 workers=DEFAULT_DOWNLOAD_CONCURRENCY,
+                 per_host=DEFAULT_DOWNLOADS_PER_HOST, max_size=0,
+                 max_cache_size=DEFAULT_CACHE_SIZE):
+        """
+        :param session_factory: callable returning a new requests session
+        :param cache_dir: directory where the files are stored
+        :param workers: number of threads downloading files
+        :param per_host: maximum number of requests to the same host at once
+        :param max_size: maximum size of the files in bytes, 0 for any
+        :param max_cache_size: maximum size of the cache in bytes, 0 for any
+        """
+        self.session_factory = session_factory
+        self.cache_dir = cache_dir
+        self.blobs_dir = os.path.join(cache_dir, "blobs")
+        self.index_dir = os.path.join(cache_dir, "index")
+        self.per_host = per_host
+        self.max_size = max_size
+        self.max_cache_size = max_cache_size
+        self.downloaded = 0
+        self.cached = 0
+        # Bytes downloaded since the cache was last pruned
+        self._added = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._prune_lock = threading.Lock()
+        self._host_semaphores = dict()
+        self._pending = dict()
+        # Downloads discarded before they started
+        self._cancelled = set()
+        for directory in (self.blobs_dir, self.index_dir):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        self._pool = ThreadPool(max(1, workers))
+
+    def submit(self, url, version=None):
+        """
+        Schedules the download of the file, if not scheduled already.
+        :param url: download url of the file
+        :param version: a value which changes whenever the file might change,
+                        e.g. the modification date of the object
+        """
+        if not url:
+            return
+        key = (url, version)
+        with self._lock:
+            self._cancelled.discard(key)
+            if key in self._pending:
+                return
+            self._pending[key] = self._pool.apply_async(
+                self._download, (url, version))
+
+    def get(self, url, version=None):
+        """
+        Waits for the file to be downloaded, scheduling it if necessary.
+        :param url: download url of the file
+        :param version: see 'submit'
+        :return: path of the file in the cache or None if it could not be
+                 downloaded
+        """
+        self.submit(url, version)
+        with self._lock:
+            result = self._pending.pop((url, version), None)
+        if result is None:
+            return None
+        return result.get()
+
+    def discard(self, url, version=None):
+        """
+        Forgets the scheduled download of a file which is not needed anymore,
+        e.g. because its object is skipped. It is not downloaded unless it
+        has started already.
+        :param url: download url of the file
+        :param version: see 'submit'
+        """
+        key = (url, version)
+        with self._lock:
+            if self._pending.pop(key, None) is not None:
+                self._cancelled.add(key)
+
+    def close(self):
+        """
+        Stops the download threads. Scheduled downloads are discarded.
+        """
+        self._pending.clear()
+        self._pool.terminate()
+        self._pool.join()
+        self.prune()
+        logger.info("Files downloaded: {}, taken from the cache: {}".format(
+                    self.downloaded, self.cached))
+
+    def _get_session(self):
+        """ Get the requests session of the current thread
+        """
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self.session_factory()
+            self._local.session = session
+        return session
+
+    def _get_host_semaphore(self, url):
+        """ Get the semaphore limiting the requests to the url's host
+        """
+        host = urlparse.urlparse(url).netloc
+        with self._lock:
+            semaphore = self._host_semaphores.get(host)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(self.per_host)
+                self._host_semaphores[host] = semaphore
+        return semaphore
+
+    def prune(self):
+        """
+        Removes the least recently used files until the cache fits in its
+        maximum size, and the index entries of the removed files.
+        """
+        if not self.max_cache_size:
+            return
+        with self._prune_lock:
+            files = list()
+            total = 0
+            for path in self._walk(self.blobs_dir):
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+            removed = 0
+            for mtime, size, path in sorted(files):
+                if total <= self.max_cache_size:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                removed += 1
+            if not removed:
+                return
+            for path in self._walk(self.index_dir):
+                if self._read_index(path) is None:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+            logger.info("Files removed from the download cache: {}".format(
+                        removed))
+
+    def _walk(self, directory):
+        """ Yield the paths of the cache files in the directory
+        """
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for filename in filter(CACHE_FILE_NAME.match, filenames):
+                yield os.path.join(dirpath, filename)
+
+    def _get_path(self, directory, key):
+        """ Get the path of a blob or an index entry by its key
+        """
+        return os.path.join(directory, key[:2], key)
+
+    def _get_index_path(self, *values):
+        """ Get the path of the index entry of the given values
+        """
+        key = hashlib.sha1("\n".join(map(str, values))).hexdigest()
+        return self._get_path(self.index_dir, key)
+
+    def _read_index(self, index_path):
+        """
+        Get the file an index entry points to.
+        :return: path of the file in the cache or None
+        """
+        try:
+            with open(index_path) as index_file:
+                digest = index_file.read().strip()
+        except IOError:
+            return None
+        if not CACHE_FILE_NAME.match(digest):
+            return None
+        path = self._get_path(self.blobs_dir, digest)
+        if not os.path.exists(path):
+            return None
+        return path
+
+    def _write_index(self, index_path, path):
+        """ Points the index entry to the file
+        """
+        self._make_dirs(index_path)
+        handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(index_path))
+        with os.fdopen(handle, "w") as index_file:
+            index_file.write(os.path.basename(path))
+        os.rename(tmp_path, index_path)
+
+    def _make_dirs(self, path):
+        """ Creates the directory of the path if necessary
+        """
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Created by another thread meanwhile
+                pass
+
+    def _download(self, url, version):
+        """
+        Downloads the file into the cache unless it is already there. Runs in
+        a worker thread, so it must not access the database.
+        :return: path of the file in the cache or None
+        """
+        with self._lock:
+            if (url, version) in self._cancelled:
+                self._cancelled.discard((url, version))
+                return None
+        session = self._get_session()
+        try:
+            with self._get_host_semaphore(url):
+                headers = None
+                if version is None:
+                    headers = self._get_headers(session, url)
+                    version = headers.get("ETag") or \
+                        headers.get("Last-Modified")
+                url_index = version and self._get_index_path(url, version)
+                path = url_index and self._read_index(url_index)
+                if path is not None:
+                    # Keep track of the last use for the pruning
+                    os.utime(path, None)
+                    self._count("cached")
+                    return path
+                if headers is None:
+                    headers = self._get_headers(session, url)
+                path = self._download_content(session, url, headers)
+                if path is not None and url_index:
+                    self._write_index(url_index, path)
+                return path
+        except Exception, e:
+            logger.error("Could not download {}: {}".format(url, e))
+            return None
+
+    def _download_content(self, session, url, headers):
+        """
+        Gets the file from the cache by the size and checksum of its HEAD
+        response, or downloads it.
+        :return: path of the file in the cache or None if it is too large
+        """
+        size = utils.to_int(headers.get("Content-Length"))
+        if self.max_size and size > self.max_size:
+            logger.warning("Skipping file larger than {} bytes: {}".format(
+                           self.max_size, url))
+            return None
+        checksum = headers.get("Digest") or headers.get("Content-MD5")
+        content_index = None
+        if size and checksum:
+            content_index = self._get_index_path(size, checksum)
+            path = self._read_index(content_index)
+            if path is not None:
+                # Keep track of the last use for the pruning
+                os.utime(path, None)
+                self._count("cached")
+                return path
+        path = self._stream_to(session, url)
+        self._count("downloaded")
+        self._added_to_cache(path)
+        if content_index:
+            self._write_index(content_index, path)
+        return path
+
+    def _added_to_cache(self, path):
+        """
+        Prunes the cache once a quarter of its maximum size has been
+        downloaded since the last time.
+        """
+        if not self.max_cache_size:
+            return
+        with self._lock:
+            self._added += os.path.getsize(path)
+            if self._added < self.max_cache_size / 4:
+                return
+            self._added = 0
+        self.prune()
+
+    def _get_headers(self, session, url):
+        """
+        Get the headers of the file's response. Not all the remote views
+        support HEAD requests, so no headers are returned if it fails.
+        """
+        try:
+            response = session.head(url, allow_redirects=True)
+            if response.ok:
+                return response.headers
+        except Exception, e:
+            logger.debug("HEAD request failed for {}: {}".format(url, e))
+        return {}
+
+    def _count(self, counter):
+        """ Increase one of the counters from a worker thread
+        """
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _stream_to(self, session, url):
+        """
+        Downloads the file in chunks to a temporary file and moves it into
+        place, named by the hash of its content, once complete. So the cache
+        never contains partial files, files with the same content are stored
+        once and the file is never kept in memory as a whole.
+        :return: path of the file in the cache
+        """
+        response = session.get(url, stream=True)
+        tmp_file = tempfile.NamedTemporaryFile(dir=self.blobs_dir,
+                                               delete=False)
+        try:
+            response.raise_for_status()
+            size = 0
+            content_hash = hashlib.sha1()
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if self.max_size and size > self.max_size:
+                    raise ValueError("File larger than {} bytes".format(
+                                     self.max_size))
+                content_hash.update(chunk)
+                tmp_file.write(chunk)
+            tmp_file.close()
+            path = self._get_path(self.blobs_dir, content_hash.hexdigest())
+            self._make_dirs(path)
+            os.rename(tmp_file.name, path)
+            return path
+        finally:
+            response.close()
+            tmp_file.close()
+            if os.path.exists(tmp_file.name):
+                os.remove(tmp_file.name)
+
+
+def open_copy(path):
+    """
+    Get a file object of a private copy of the cached file, which can be
+    consumed (e.g. moved) by the blob storage. The copy is a hard link if the
+    file system supports it.
+    :param path: path of the file in the cache
+    :return: file object opened for reading
+    """
+    handle, copy_path = tempfile.mkstemp(prefix="senaite.sync-",
+                                         dir=os.path.dirname(path))
+    os.close(handle)
+    os.remove(copy_path)
+    try:
+        os.link(path, copy_path)
+    except (OSError, AttributeError):
+        shutil.copyfile(path, copy_path)
+    return open(copy_path, "rb")
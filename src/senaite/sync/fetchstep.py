@@ -16,10 +16,17 @@ from senaite import api
 from senaite.sync.syncstep import SyncStep
 from senaite.sync import logger
 from senaite.sync import _
-from senaite.sync.souphandler import SoupHandler
+from senaite.sync.importcursor import IMPORT_CURSOR
+from senaite.sync.mappingstore import get_mapping_handler
 from senaite.sync.souphandler import REMOTE_UID
+from senaite.sync.uidlist import UIDList
 from senaite.sync import utils
 
+# Key of the fetch checkpoint in the domain storage
+FETCH_CHECKPOINT = "fetch_checkpoint"
+# Number of pages fetched between two checkpoints
+CHECKPOINT_INTERVAL = 10
+
 
 class FetchStep(SyncStep):
     """
@@ -31,17 +38,28 @@ class FetchStep(SyncStep):
         self.credentials = credentials
         self.config = config
 
-    def run(self):
+    def run(self, resume=False):
         """
+        :param resume: continue the data fetch from the last checkpoint, if
+                       there is any, instead of starting it over
         :return:
         """
         logger.info("*** FETCH STARTED {} ***".format(
                                                 self.domain_name))
-        if self.import_registry:
-            self._fetch_registry_records(keys=["bika", "senaite"])
-        if self.import_settings:
-            self._fetch_settings()
-        self._fetch_data()
+        if self.session is None:
+            self.session = self.get_session()
+        checkpoint = None
+        if resume:
+            checkpoint = self.get_storage().get(FETCH_CHECKPOINT)
+            if checkpoint is None:
+                logger.warning("No fetch checkpoint found for {}, starting "
+                               "over".format(self.domain_name))
+        if checkpoint is None:
+            if self.import_registry:
+                self._fetch_registry_records(keys=["bika", "senaite"])
+            if self.import_settings:
+                self._fetch_settings()
+        self._fetch_data(checkpoint=checkpoint)
         logger.info("*** FETCH FINISHED {} ***".format(
                                                 self.domain_name))
         return
@@ -88,22 +106,34 @@ class FetchStep(SyncStep):
         """
         return self.get_first_item("users/current")
 
-    def _fetch_data(self, window=1000, overlap=10):
-        """Fetch data from the uid catalog in the source URL
+    def _fetch_data(self, window=1000, overlap=10, checkpoint=None):
+        """Fetch data from the uid catalog in the source URL. The position
+        reached is saved every CHECKPOINT_INTERVAL pages along with the data
+        fetched so far, and before failing if a page can not be fetched, so
+        an interrupted fetch can be resumed from there.
         :param window: number of elements to be retrieved with each query to
                        the catalog
         :type window: int
-        :param overlap: overlap between windows
+        :param overlap: overlap between windows, only used when paginating
+                        by offsets
         :type overlap: int
+        :param checkpoint: checkpoint to resume the fetch from
         :return:
         """
         logger.info("*** FETCHING DATA: {} ***".format(
             self.domain_name))
         start_time = datetime.now()
         storage = self.get_storage()
-        storage["ordered_uids"] = []
+        if checkpoint is None:
+            storage["ordered_uids"] = UIDList()
+            for key in (FETCH_CHECKPOINT, IMPORT_CURSOR):
+                if key in storage:
+                    del storage[key]
+        else:
+            logger.info("Resuming fetch from checkpoint: {}".format(
+                checkpoint))
         ordered_uids = storage["ordered_uids"]
-        self.sh = SoupHandler(self.domain_name)
+        self.sh = get_mapping_handler(self.domain_name)
         # Dummy query to get overall number of items in the specified catalog
         query = {
             "url_or_endpoint": "search",
@@ -115,10 +145,8 @@ class FetchStep(SyncStep):
             types.extend(self.full_sync_types + self.prefixable_types +
                          self.update_only_types + self.read_only_types)
             query["portal_type"] = types
+        query = self.get_listing_query(query)
         cd = self.get_json(**query)
-        # Knowing the catalog length compute the number of pages we will need
-        # with the desired window size and overlap
-        effective_window = window-overlap
         # When we receive an error message in JSON response or we
         # don't get any response at all the key 'count' doesn't exist.
         if not cd.get("count", None):
@@ -128,33 +156,58 @@ class FetchStep(SyncStep):
             )
             return
 
-        number_of_pages = (cd["count"]/effective_window) + 1
+        number_of_pages = self.count_pages(
+            cd["count"], window, overlap,
+            cursor_pagination=self.is_cursor_pagination(checkpoint))
+        # Pages handled before the fetch was interrupted. Checkpoints saved
+        # without the number of pages are estimated from the UIDs fetched
+        first_page = 0
+        if checkpoint:
+            first_page = checkpoint.get("pages", len(ordered_uids) / window)
         # Retrieve data from catalog in batches with size equal to window,
-        # format it and insert it into the import soup
-        for current_page in xrange(number_of_pages):
-            start_from = (current_page * window) - overlap
-            query["limit"] = window
-            query["b_start"] = start_from
-            items = self.get_items_with_retry(**query)
-            if not items:
-                logger.error("CAN NOT GET ITEMS FROM {} TO {}".format(
-                    start_from, start_from+window))
+        # format it and insert it into the import soup. Pages are handled in
+        # a deterministic order, even when several are requested at once.
+        pages = enumerate(self.yield_checkpointed_pages(
+            query, cd["count"], window, overlap, checkpoint), first_page)
+        last_position = None
+        while True:
+            try:
+                current_page, (items, position) = next(pages)
+            except StopIteration:
+                break
+            except Exception:
+                # Keep the pages handled so far, so resuming the fetch starts
+                # right after them, e.g. from the last UID of a failed range
+                if last_position is not None:
+                    storage[FETCH_CHECKPOINT] = last_position
+                    transaction.commit()
+                    logger.info("Fetch checkpoint saved: {}".format(
+                        last_position))
+                raise
+            # skip objects or extract the required data for the import
+            items = filter(self.is_item_allowed, items)
+            rows = map(utils.get_soup_format, items)
+            self.sh.bulk_insert(rows)
+            for row in rows:
+                ordered_uids.append(row[REMOTE_UID])
             for item in items:
-                # skip object or extract the required data for the import
-                if not self.is_item_allowed(item):
-                    continue
-                data_dict = utils.get_soup_format(item)
-                rec_id = self.sh.insert(data_dict)
-                ordered_uids.insert(0, data_dict[REMOTE_UID])
                 if not self._parents_fetched(item):
                     logger.warning("Some parents are missing: {} ".format(item))
 
             utils.log_process(task_name="Pages fetched", started=start_time,
                               processed=current_page+1, total=number_of_pages)
 
+            last_position = position
+            if (current_page + 1) % CHECKPOINT_INTERVAL == 0:
+                storage[FETCH_CHECKPOINT] = position
+                transaction.commit()
+                logger.info("Fetch checkpoint saved: {}".format(position))
+
         logger.info("*** FETCHING DATA FINISHED: {} ***".format(
             self.domain_name))
 
+        if FETCH_CHECKPOINT in storage:
+            del storage[FETCH_CHECKPOINT]
         transaction.commit()
 
     def _fetch_settings(self, keys=None):
@@ -182,8 +235,8 @@ class FetchStep(SyncStep):
          to the keyword. If key is None it will return all the settings
         """
         if key is None:
-            return self.get_items("settings")
-        return self.get_items("/".join(["settings", key]))
+            return list(self.get_items("settings"))
+        return list(self.get_items("/".join(["settings", key])))
 
     def _fetch_registry_records(self, keys=None):
         """Fetch configuration registry records of interest (those associated
@@ -216,5 +269,5 @@ class FetchStep(SyncStep):
         If keyword is None it returns the whole registry
         """
         if key is None:
-            return self.get_items("registry")
-        return self.get_items("/".join(["registry", key]))
+            return list(self.get_items("registry"))
+        return list(self.get_items("/".join(["registry", key])))
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SYNC
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+from collections import namedtuple
+
+from senaite.jsonapi.fieldmanagers import ComputedFieldManager
+from senaite.jsonapi.fieldmanagers import ProxyFieldManager
+from senaite.jsonapi.interfaces import IFieldManager
+
+FILE_FIELD_TYPES = ("file", "image", "blob")
+
+# A field to be set during the import
+PlannedField = namedtuple("PlannedField",
+                          ["name", "field", "manager", "is_file", "is_proxy"])
+
+
+class FieldPlan(object):
+    """
+    The fields of a portal type to be set when importing its objects, with
+    their field managers. Computed fields and the fields to be skipped are
+    left out, and Proxy Fields come last, since they must be set after the
+    objects they depend on are already set.
+    """
+
+    def __init__(self, fields, fields_to_skip=()):
+        """
+        :param fields: dictionary of {name: field} of the schema
+        :param fields_to_skip: names of the fields not to be set
+        """
+        planned = []
+        proxies = []
+        for name, field in fields.items():
+            if name in fields_to_skip:
+                continue
+            fm = IFieldManager(field)
+            # Computed Fields don't have set methods.
+            if isinstance(fm, ComputedFieldManager):
+                continue
+            is_proxy = isinstance(fm, ProxyFieldManager)
+            entry = PlannedField(name, field, fm,
+                                 field.type in FILE_FIELD_TYPES, is_proxy)
+            if is_proxy:
+                proxies.append(entry)
+            else:
+                planned.append(entry)
+        self.fields = planned + proxies
+        self.fieldnames = [entry.name for entry in self.fields]
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+
+def get_dependencies(data, keys):
+    """
+    Finds the UIDs of the objects referenced in the data. References are
+    dictionaries with an 'uid' key, or lists of dictionaries with keys
+    containing 'uid'.
+    :param data: object data from the JSON API
+    :param keys: keys of the data to be looked into
+    :return: list of referenced UIDs without duplicates
+    """
+    dependencies = []
+    for key in keys:
+        value = data.get(key)
+        if isinstance(value, dict) and value.get("uid"):
+            dependencies.append(value.get("uid"))
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                if isinstance(item, dict):
+                    for k, v in item.iteritems():
+                        if 'uid' in k and v:
+                            dependencies.append(v)
+
+    # Remove duplicates keeping the order
+    seen = set()
+    return [uid for uid in dependencies
+            if not (uid in seen or seen.add(uid))]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SYNC
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+from BTrees.OOBTree import OOTreeSet
+from persistent import Persistent
+
+# Key of the import cursor in the domain storage
+IMPORT_CURSOR = "import_cursor"
+
+
+class ImportCursor(Persistent):
+    """
+    Progress of the import of a domain. It is stored in the domain storage
+    and committed along with the imported objects, so a restarted import
+    continues right after the last committed object.
+    """
+
+    def __init__(self):
+        # Number of fetched UIDs handled, from the end of the list
+        self.position = 0
+        # Remote UIDs of the objects whose import failed
+        self.failed = OOTreeSet()
+
+    def add_failed(self, r_uid):
+        self.failed.insert(r_uid)
+
+    def remove_failed(self, r_uid):
+        if r_uid in self.failed:
+            self.failed.remove(r_uid)
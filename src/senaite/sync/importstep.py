@@ -5,15 +5,16 @@
 # Copyright 2018 by it's authors.
 # Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
 
+import itertools
+import os
 import requests
 import transaction
 
 from Products.CMFPlone.utils import _createObjectByType
 from Products.AdvancedQuery import Eq
 from datetime import datetime
-from senaite.jsonapi.fieldmanagers import ProxyFieldManager
-from senaite.jsonapi.fieldmanagers import ComputedFieldManager
 from senaite.sync.syncstep import SyncStep
+from senaite.sync.syncstep import API_BATCH_SIZE
 
 from zope.component import getUtility
 from zope.component import getAdapter
@@ -24,15 +25,33 @@ from plone.registry.interfaces import IRegistry
 import plone.app.controlpanel as cp
 
 from senaite import api
-from senaite.jsonapi.interfaces import IFieldManager
 from senaite.sync import logger
 from senaite.sync import _
-from senaite.sync.souphandler import SoupHandler
+from senaite.sync.dependencygraph import DependencyGraph
+from senaite.sync.downloader import DEFAULT_CACHE_SIZE
+from senaite.sync.downloader import DEFAULT_DOWNLOAD_CONCURRENCY
+from senaite.sync.downloader import Downloader
+from senaite.sync.downloader import get_default_cache_dir
+from senaite.sync.downloader import open_copy
+from senaite.sync.fieldplan import FieldPlan
+from senaite.sync.fieldplan import get_dependencies
+from senaite.sync.importcursor import IMPORT_CURSOR
+from senaite.sync.importcursor import ImportCursor
+from senaite.sync.reindexqueue import COMPUTED_INDEXES
+from senaite.sync.reindexqueue import ReindexQueue
+from senaite.sync.mappingstore import get_mapping_handler
 from senaite.sync.souphandler import REMOTE_UID, LOCAL_UID, REMOTE_PATH,\
-                                     PORTAL_TYPE, LOCAL_PATH
+                                     PORTAL_TYPE, LOCAL_PATH, REMOTE_MODIFIED
+from senaite.sync.uidlist import UIDList
 from senaite.sync import utils
 
 COMMIT_INTERVAL = 1000
+# Number of threads fetching object data ahead of the import
+DEFAULT_IMPORT_CONCURRENCY = 2
+# Maximum number of objects whose data is fetched ahead of the import
+DEFAULT_PREFETCH_SIZE = 500
+# Number of objects whose dependencies are planned and imported together
+IMPORT_WINDOW = 250
 
 CONTROLPANEL_INTERFACE_MAPPING = {
     'mail': [cp.mail.IMailSchema],
@@ -68,14 +87,41 @@ class ImportStep(SyncStep):
 
     def __init__(self, credentials, config):
         SyncStep.__init__(self, credentials, config)
-        # A list to keep UID's of an object chunk
-        self.uids_to_reindex = []
-        # An 'infinite recursion preventative' list of objects which are
-        # being updated.
-        self._queue = []
-        # An Integer to count the number of non-committed objects.
-        self._non_commited_objects = 0
+        # Objects to be reindexed before the next commit
+        self.reindex_queue = ReindexQueue()
         self.skipped = []
+        # Remote UIDs of the objects updated during this run
+        self._updated_uids = set()
+        # Field plans by portal type, computed once per run from the first
+        # object of each type
+        self._field_plans = dict()
+        # Field plans by portal type from temporary instances, only used to
+        # find dependencies before any object of the type exists
+        self._type_field_plans = dict()
+        # Portal types without local objects, see '_get_existing_object'
+        self._types_without_objects = set()
+        # Progress of the import, see '_get_import_cursor'
+        self.import_cursor = None
+
+        self.import_concurrency = utils.to_int(
+            config.get("import_concurrency"), DEFAULT_IMPORT_CONCURRENCY)
+        self.prefetch_size = utils.to_int(
+            config.get("prefetch_size"), DEFAULT_PREFETCH_SIZE)
+        # Number of objects to be reindexed before committing
+        self.commit_interval = utils.to_int(
+            config.get("commit_interval"), COMMIT_INTERVAL)
+        # Maximum size of the attachments to be downloaded in MB, 0 for any
+        self.max_attachment_size = utils.to_int(
+            config.get("max_attachment_size"), 0) * 1024 * 1024
+        self.download_concurrency = utils.to_int(
+            config.get("download_concurrency"), DEFAULT_DOWNLOAD_CONCURRENCY)
+        self.download_cache_dir = config.get("download_cache_dir") or \
+            get_default_cache_dir(self.domain_name)
+        # Maximum size of the download cache in MB, 0 for any
+        self.download_cache_size = utils.to_int(
+            config.get("download_cache_size"),
+            DEFAULT_CACHE_SIZE / 1024 / 1024) * 1024 * 1024
+        self._downloader = None
 
     def run(self):
         """
@@ -209,92 +255,458 @@ class ImportStep(SyncStep):
         """
         logger.info("*** IMPORT DATA STARTED: {} ***".format(self.domain_name))
 
-        self.sh = SoupHandler(self.domain_name)
-        self.uids_to_reindex = []
+        self.sh = get_mapping_handler(self.domain_name)
+        self.reindex_queue = ReindexQueue()
         storage = self.get_storage()
         ordered_uids = storage["ordered_uids"]
         total_object_count = len(ordered_uids)
         start_time = datetime.now()
 
-        for item_index, r_uid in enumerate(ordered_uids):
-            row = self.sh.find_unique(REMOTE_UID, r_uid)
-            logger.debug("Handling: {} ".format(row[REMOTE_PATH]))
-            self._handle_obj(row)
-
-            # Handling object means there is a chunk containing several objects
-            # which have been created and updated. Reindex them now.
-            self.uids_to_reindex = list(set(self.uids_to_reindex))
-            for uid in self.uids_to_reindex:
-                # It is possible that the object has a method (not a Field
-                # in its Schema) which is used as an index and it fails.
-                # TODO: Make sure reindexing won't fail!
-                try:
-                    obj = api.get_object_by_uid(uid)
-                    obj.reindexObject()
-                except Exception, e:
-                    rec = self.sh.find_unique(LOCAL_UID, uid)
-                    logger.error("Error while reindexing {} - {}"
-                                 .format(rec, e))
-            self._non_commited_objects += len(self.uids_to_reindex)
-            self.uids_to_reindex = []
-
-            # Commit the transaction if necessary
-            if self._non_commited_objects > COMMIT_INTERVAL:
-                transaction.commit()
-                logger.info("Committed: {} / {} ".format(
-                            self._non_commited_objects, total_object_count))
-                self._non_commited_objects = 0
+        # Continue right after the objects committed by a previous run, and
+        # retry the ones which failed in it first
+        self.import_cursor = self._get_import_cursor()
+        position = self.import_cursor.position
+        if position or self.import_cursor.failed:
+            logger.info("Resuming import at {} / {}, retrying {} failed "
+                        "objects".format(position, total_object_count,
+                                         len(self.import_cursor.failed)))
+        retry = [(row, None) for row, pos in
+                 self._yield_rows(list(self.import_cursor.failed))]
+
+        # Fetched UIDs are imported from the last to the first one, while the
+        # data of the next objects is fetched in the background
+        rows = itertools.chain(retry, self._yield_rows(
+            ordered_uids.iter_reversed(skip=position), start=position))
+        prefetched = self._prefetch_data(rows)
+        try:
+            self._import_prefetched(prefetched, total_object_count, start_time,
+                                    processed=position)
+        finally:
+            # Stop the background threads, also if the import failed
+            prefetched.close()
+            self._close_downloader()
 
-            # Log.info every 50 objects imported
-            utils.log_process(task_name="Data Import", started=start_time,
-                              processed=item_index+1, total=total_object_count,
-                              frequency=50)
+        self._flush_reindex_queue()
 
         # Delete the UID list from the storage.
-        storage["ordered_uids"] = []
+        storage["ordered_uids"] = UIDList()
+        del storage[IMPORT_CURSOR]
+        self.import_cursor = None
 
         self._recover_failed_objects()
+        self._close_downloader()
 
         # Mark all objects as non-updated for the next import.
         self.sh.reset_updated_flags()
 
         logger.info("*** END OF DATA IMPORT: {} ***".format(self.domain_name))
 
-    def _handle_obj(self, row, handle_dependencies=True):
+    def _get_import_cursor(self):
+        """ Get the import cursor of the domain, creating it if necessary
+        """
+        storage = self.get_storage()
+        if storage.get(IMPORT_CURSOR) is None:
+            storage[IMPORT_CURSOR] = ImportCursor()
+        return storage[IMPORT_CURSOR]
+
+    def _yield_rows(self, r_uids, start=0):
+        """ Yield the soup rows of the given remote UIDs, along with the
+        number of UIDs handled once the row is imported
+        """
+        for position, r_uid in enumerate(r_uids, start + 1):
+            row = self.sh.find_unique(REMOTE_UID, r_uid)
+            if row is None:
+                logger.error("Remote UID not found in fetched data: {}"
+                             .format(r_uid))
+                continue
+            yield row, position
+
+    def _prefetch_data(self, rows):
+        """ Fetch the complete data of the rows' objects in background threads
+        and yield (row, data, position) tuples in the order of the rows. Data
+        is requested in batches and at most 'prefetch_size' objects are
+        fetched ahead of the consumer.
+        :param rows: iterable of (row, position) tuples
+        """
+        batches = utils.ordered_parallel_map(
+            self._fetch_objs_data, utils.chunks(rows, API_BATCH_SIZE),
+            workers=self.import_concurrency,
+            lookahead=max(1, self.prefetch_size / API_BATCH_SIZE),
+            initializer=self.init_thread_session)
+        try:
+            for batch in batches:
+                for row_data in batch:
+                    yield row_data
+        finally:
+            batches.close()
+
+    def _fetch_objs_data(self, rows):
+        """ Fetch the complete data of the rows' objects. Runs in a worker
+        thread, so it must not access the database.
+        :param rows: list of (row, position) tuples
+        :return: list of (row, data, position) tuples. Data is None if it is
+                 not needed or could not be retrieved
+        """
+        uids = [row[REMOTE_UID] for row, position in rows
+                if not self.sh.is_updated(row)]
+        try:
+            objs_data = self.get_objects_data(uids)
+        except Exception, e:
+            logger.error("Failed to fetch data of {} : {}".format(uids, e))
+            objs_data = {}
+        return [(row, objs_data.get(row[REMOTE_UID]), position)
+                for row, position in rows]
+
+    def _import_prefetched(self, prefetched, total_object_count, start_time,
+                           processed=0):
+        """ Create and update the objects of the prefetched
+        (row, data, position) tuples window by window. The position reached is
+        saved in the import cursor with every commit.
+        """
+        for window in utils.chunks(prefetched, IMPORT_WINDOW):
+            self._import_window([(row, data) for row, data, pos in window])
+            positions = filter(None, [pos for row, data, pos in window])
+            if positions:
+                processed = positions[-1]
+
+            # Objects created and updated in the window are reindexed only
+            # once, right before the transaction is committed.
+            if len(self.reindex_queue) > self.commit_interval:
+                committed = self._flush_reindex_queue()
+                self.import_cursor.position = processed
+                transaction.commit()
+                logger.info("Committed: {} / {} ".format(
+                            committed, total_object_count))
+
+            utils.log_process(task_name="Data Import", started=start_time,
+                              processed=processed, total=total_object_count)
+
+    def _flush_reindex_queue(self):
+        """ Reindex the objects in the queue
+        :return: number of objects reindexed
+        """
+        count = self.reindex_queue.flush()
+        logger.info("Reindexed {} objects, {} reindexes saved so far".format(
+                    count, self.reindex_queue.saved))
+        return count
+
+    def _is_updated(self, row):
+        """ Check if the object of the row has been already updated
+        """
+        return self.sh.is_updated(row) or \
+            row[REMOTE_UID] in self._updated_uids
+
+    def _import_window(self, window):
+        """
+        Imports the objects of a window of prefetched (row, data) tuples:
+            1. Builds the graph of the objects and the dependencies they need
+            2. Imports the strongly connected components of the graph in
+               topological order, so dependencies are always imported before
+               the objects referencing them
+            3. Objects referencing each other (cycles) are imported in two
+               passes: first all their slugs are created, then they are updated
+               with data
+
+        :param window: list of (row, data) tuples
+        """
+        graph = DependencyGraph()
+        rows = dict()
+        objs_data = dict()
+        for row, obj_data in window:
+            if self._is_updated(row):
+                continue
+            r_uid = row[REMOTE_UID]
+            graph.add_node(r_uid)
+            rows[r_uid] = row
+            objs_data[r_uid] = obj_data
+
+        self._plan_dependencies(graph, rows, objs_data)
+        import_order = graph.get_import_order()
+
+        # Files are downloaded in the background in the order they are needed
+        for component in import_order:
+            for r_uid in component:
+                if rows.get(r_uid) is not None:
+                    self._schedule_downloads(objs_data.get(r_uid))
+
+        for component in import_order:
+            component = filter(lambda uid: rows.get(uid) is not None,
+                               component)
+            if len(component) > 1:
+                logger.debug("Objects referencing each other: {}".format(
+                             component))
+                for r_uid in component:
+                    try:
+                        self._do_obj_creation(rows[r_uid])
+                    except Exception, e:
+                        logger.error("Object creation failed for: {} ... {}"
+                                     .format(rows[r_uid], str(e)))
+
+            for r_uid in component:
+                # Skip it if it has been imported in a previous window
+                if r_uid in self._updated_uids:
+                    continue
+                logger.debug("Handling: {} ".format(rows[r_uid][REMOTE_PATH]))
+                self._handle_obj(rows[r_uid], obj_data=objs_data.get(r_uid))
+
+        # Files of the objects which were skipped are not needed anymore
+        for r_uid in rows:
+            self._discard_downloads(objs_data.get(r_uid))
+
+    def _plan_dependencies(self, graph, rows, objs_data):
+        """
+        Adds the dependencies of the graph's objects to the graph, level by
+        level, fetching the data of each level at once. Dependencies which are
+        not in the fetched data are inserted into the soup, but their own
+        dependencies are not followed.
+
+        :param graph: the DependencyGraph with the objects to be imported
+        :param rows: dict of soup rows by remote UID, completed in place
+        :param objs_data: dict of object data by remote UID, completed in place
+        """
+        to_expand = list(graph)
+        not_fetched = []
+        while to_expand:
+            missing = [uid for uid in to_expand if not objs_data.get(uid)]
+            objs_data.update(self.get_objects_data(missing))
+
+            next_level = []
+            for r_uid in to_expand:
+                obj_data = objs_data.get(r_uid)
+                if not obj_data:
+                    continue
+                for dep_uid in self._get_dependencies(obj_data):
+                    # Setting references to itself doesn't need any planning
+                    if dep_uid == r_uid:
+                        continue
+                    if dep_uid in graph:
+                        graph.add_dependency(r_uid, dep_uid)
+                        continue
+                    dep_row = self.sh.find_unique(REMOTE_UID, dep_uid)
+                    if dep_row is not None and self._is_updated(dep_row):
+                        # Reindex dependency just in case it has an index that
+                        # uses BackReference of this object. Its fields don't
+                        # change, so only the computed indexes can.
+                        self.reindex_queue.add(dep_row.get(LOCAL_UID),
+                                               idxs=[COMPUTED_INDEXES])
+                        continue
+                    graph.add_dependency(r_uid, dep_uid)
+                    rows[dep_uid] = dep_row
+                    if dep_row is None:
+                        not_fetched.append(dep_uid)
+                    else:
+                        next_level.append(dep_uid)
+            to_expand = next_level
+
+        # If dependency doesn't exist in fetched data table, just try to
+        # create its object for the first time
+        objs_data.update(self.get_objects_data(not_fetched))
+        for r_uid in not_fetched:
+            dep_item = objs_data.get(r_uid)
+            if not dep_item:
+                logger.error("Remote UID not found in fetched data: {}".
+                             format(r_uid))
+                continue
+            if not utils.has_valid_portal_type(dep_item):
+                logger.error("Skipping dependency with unknown portal type:"
+                             " {}".format(dep_item))
+                continue
+            data_dict = utils.get_soup_format(dep_item)
+            rec_id = self.sh.insert(data_dict)
+            if rec_id is False or not self._parents_fetched(dep_item):
+                continue
+            rows[r_uid] = self.sh.get_record_by_id(rec_id, as_dict=True)
+
+    def _get_downloader(self):
+        """ Get the downloader of the run, starting it if necessary
+        """
+        if self._downloader is None:
+            self._downloader = Downloader(
+                self.get_session, self.download_cache_dir,
+                workers=self.download_concurrency,
+                max_size=self.max_attachment_size,
+                max_cache_size=self.download_cache_size)
+        return self._downloader
+
+    def _close_downloader(self):
+        """ Stop the download threads, if started
+        """
+        if self._downloader is not None:
+            self._downloader.close()
+            self._downloader = None
+
+    def _schedule_downloads(self, data):
+        """
+        Schedules the download of the files of the object data.
+        :param data: object data
+        """
+        for fileinfo in self._get_file_infos(data):
+            self._get_downloader().submit(fileinfo.get("download"),
+                                          data.get("modified"))
+
+    def _discard_downloads(self, data):
+        """
+        Discards the scheduled downloads of the object data which have not
+        been used, e.g. because the object was skipped.
+        :param data: object data
+        """
+        if self._downloader is None:
+            return
+        for fileinfo in self._get_file_infos(data):
+            self._downloader.discard(fileinfo.get("download"),
+                                     data.get("modified"))
+
+    def _get_file_infos(self, data):
+        """
+        Get the file information of the object data which is to be set, i.e.
+        of the file fields in the field plan of its portal type.
+        :param data: object data
+        :return: list of file information dictionaries with a download url
+        """
+        if not data:
+            return []
+        plan = self._get_type_field_plan(data.get("portal_type"))
+        if plan is None:
+            return []
+        fileinfos = []
+        for planned in plan:
+            value = data.get(planned.name)
+            if planned.is_file and isinstance(value, dict) and \
+                    value.get("download"):
+                fileinfos.append(value)
+        return fileinfos
+
+    def _get_dependencies(self, data):
+        """
+        Dependencies are found as UIDs in object data. Only the fields of the
+        field plan are looked into. If there is no plan for the portal type,
+        e.g. it is not an Archetypes type, all the keys of the data are.
+        :param data: object data
+        :return: list of remote UIDs of the objects it depends on
+        """
+        plan = self._get_type_field_plan(data.get("portal_type"))
+        if plan is not None:
+            keys = plan.fieldnames
+        else:
+            keys = [key for key in data.keys()
+                    if key not in self.fields_to_skip and
+                    key != "workflow_info"]
+        return get_dependencies(data, keys)
+
+    def _get_type_field_plan(self, portal_type):
+        """
+        Get the field plan of the portal type, to find the dependencies of
+        its objects. It is the plan of the real objects of the type, taken
+        from an existing object if there is no plan yet. Before any object of
+        the type exists, the schema is taken from a temporary instance of the
+        type's class, as schema extenders add fields to the instances only.
+        Plans are cached for the run.
+        :param portal_type: portal type of the objects to be imported
+        :return: FieldPlan or None if the schema can not be found
+        """
+        plan = self._field_plans.get(portal_type)
+        if plan is not None:
+            return plan
+        obj = self._get_existing_object(portal_type)
+        if obj is not None:
+            return self._get_field_plan(obj)
+        if portal_type in self._type_field_plans:
+            return self._type_field_plans[portal_type]
+        plan = None
+        at_tool = api.get_tool("archetype_tool")
+        for type_info in at_tool.listRegisteredTypes():
+            if type_info.get("portal_type") != portal_type:
+                continue
+            try:
+                instance = type_info["klass"](portal_type).__of__(self.portal)
+                plan = FieldPlan(api.get_fields(instance), self.fields_to_skip)
+            except Exception, e:
+                logger.warning("Could not get the schema of {}: {}".format(
+                               portal_type, e))
+            break
+        self._type_field_plans[portal_type] = plan
+        return plan
+
+    def _get_existing_object(self, portal_type):
+        """
+        Get a local object of the portal type, if there is any. Portal types
+        without objects are not searched again during the run.
+        :param portal_type: portal type name
+        :return: object or None
+        """
+        if portal_type in self._types_without_objects:
+            return None
+        try:
+            brains = api.search({"portal_type": portal_type,
+                                 "sort_limit": 1})
+            if brains:
+                return api.get_object(brains[0])
+        except Exception, e:
+            logger.debug("Could not search objects of {}: {}".format(
+                         portal_type, e))
+        self._types_without_objects.add(portal_type)
+        return None
+
+    def _get_field_plan(self, obj):
+        """
+        Get the field plan of the object's portal type. It is computed from
+        the first object of each portal type, existing or just created, and
+        cached for the run.
+        :param obj: object to be updated
+        :return: FieldPlan
+        """
+        portal_type = api.get_portal_type(obj)
+        plan = self._field_plans.get(portal_type)
+        if plan is None:
+            plan = FieldPlan(api.get_fields(obj), self.fields_to_skip)
+            self._field_plans[portal_type] = plan
+        return plan
+
+    def _handle_obj(self, row, obj_data=None):
         """
         With the given dictionary:
             1. Creates object's slug
-            2. Creates and updates dependencies of the object (which actually
-               means this _handle_obj function will be called for the dependency
-               if the dependency is not updated
-            3. Updates the object
+            2. Updates the object
+
+        Dependencies of the object are expected to be already imported, see
+        '_import_window'.
 
         :param row: A row dictionary from the souper
         :type row: dict
+        :param obj_data: complete data of the object if already fetched
+        :type obj_data: dict
         """
         r_uid = row.get(REMOTE_UID)
         try:
-            if row.get("updated", "0") == "1":
+            if self.sh.is_updated(row):
                 return True
-            self._queue.append(r_uid)
             obj = self._do_obj_creation(row)
             if obj is None:
                 logger.error('Object creation failed: {}'.format(row))
+                self._add_failed(r_uid)
                 return
-            obj_data = self.get_json(r_uid, complete=True,
-                                     workflow=True)
-            if handle_dependencies:
-                self._create_dependencies(obj, obj_data)
+            if obj_data is None:
+                obj_data = self.get_json(r_uid, complete=True,
+                                         workflow=True)
             self._update_object_with_data(obj, obj_data)
             self._set_object_permission(obj)
-            self.sh.mark_update(r_uid)
-            self._queue.remove(r_uid)
+            self.sh.mark_update(r_uid, **{
+                REMOTE_MODIFIED: obj_data.get("modified") or ""})
+            self._updated_uids.add(r_uid)
+            if self.import_cursor is not None:
+                self.import_cursor.remove_failed(r_uid)
         except Exception, e:
-            self._queue.remove(r_uid)
             logger.error('Failed to handle {} : {} '.format(row, str(e)))
+            self._add_failed(r_uid)
 
         return True
 
+    def _add_failed(self, r_uid):
+        """ Remember the object failed, so a resumed import retries it
+        """
+        if self.import_cursor is not None:
+            self.import_cursor.add_failed(r_uid)
+
     def _do_obj_creation(self, row):
         """
         With the given dictionary:
@@ -396,88 +808,20 @@ class ImportStep(SyncStep):
         self.sh.update_by_remote_path(p_path, local_uid=p_local_uid)
         return True
 
-    def _create_dependencies(self, obj, data):
-        """
-        Creates and updates objects' dependencies if they are not in the queue.
-        Dependencies are found as UIDs in object data.
-        :param obj: an object to get dependencies created
-        :param data: object data
-        """
-
-        dependencies = []
-
-        for fieldname, field in api.get_fields(obj).items():
-
-            if fieldname in self.fields_to_skip:
-                continue
-
-            value = data.get(fieldname)
-
-            if isinstance(value, dict) and value.get("uid"):
-                dependencies.append(value.get("uid"))
-            elif isinstance(value, (list, tuple)):
-                for item in value:
-                    if isinstance(item, dict):
-                        for k, v in item.iteritems():
-                            if 'uid' in k:
-                                dependencies.append(v)
-
-        logger.debug("Dependencies of {} are : {} ".format(repr(obj),
-                                                          dependencies))
-        dependencies = list(set(dependencies))
-        for r_uid in dependencies:
-            dep_row = self.sh.find_unique(REMOTE_UID, r_uid)
-            if dep_row is None:
-                # If dependency doesn't exist in fetched data table,
-                # just try to create its object for the first time
-                dep_item = self.get_json(r_uid)
-                if not dep_item:
-                    logger.error("Remote UID not found in fetched data: {}".
-                                 format(r_uid))
-                    continue
-                if not utils.has_valid_portal_type(dep_item):
-                    logger.error("Skipping dependency with unknown portal type:"
-                                 " {}".format(dep_item))
-                    continue
-                data_dict = utils.get_soup_format(dep_item)
-                rec_id = self.sh.insert(data_dict)
-                dep_row = self.sh.get_record_by_id(rec_id, as_dict=True)
-                if self._parents_fetched(dep_item):
-                    self._handle_obj(dep_row, handle_dependencies=False)
-                continue
-
-            # If Dependency is being processed, skip it.
-            if r_uid in self._queue:
-                continue
-
-            # No need to handle already updated objects
-            if dep_row.get("updated") == "0":
-                self._handle_obj(dep_row)
-            # Reindex dependency just in case it has a field that uses
-            # BackReference of this object.
-            else:
-                self.uids_to_reindex.append(dep_row.get(LOCAL_UID))
-
-        return True
-
     def _update_object_with_data(self, obj, data):
         """Update an existing object with data
         """
-        # Proxy Fields must be set after its dependency object is already set.
-        # Thus, we will store all the ProxyFields and set them in the end
-        proxy_fields = []
-
-        for fieldname, field in api.get_fields(obj).items():
-
-            if fieldname in self.fields_to_skip:
-                continue
-
-            fm = IFieldManager(field)
+        # Proxy Fields must be set after its dependency object is already set,
+        # so they come last in the field plan.
+        for planned in self._get_field_plan(obj):
+            fieldname = planned.name
             value = data.get(fieldname)
-            kwargs = {}
 
-            # Computed Fields don't have set methods.
-            if isinstance(fm, ComputedFieldManager):
+            # handle file fields
+            if planned.is_file:
+                if value is not None:
+                    self._set_file_field(obj, planned, value,
+                                         data.get("modified"))
                 continue
 
             # handle JSON data reference fields
@@ -500,41 +844,13 @@ class ImportStep(SyncStep):
                                 local_uid = self.sh.get_local_uid(v)
                                 item[k] = local_uid
 
-            # handle file fields
-            if field.type in ("file", "image", "blob"):
-                if data.get(fieldname) is not None:
-                    fileinfo = data.get(fieldname)
-                    url = fileinfo.get("download")
-                    filename = fileinfo.get("filename")
-                    kwargs["filename"] = filename
-                    response = self.session.get(url)
-                    value = response.content
-
-            # Leave the Proxy Fields for later
-            if isinstance(fm, ProxyFieldManager):
-                proxy_fields.append({'field_name': fieldname,
-                                     'fm': fm, 'value': value})
-                continue
             try:
-                fm.set(obj, value, **kwargs)
+                planned.manager.set(obj, value)
             except:
                 logger.debug(
                     "Could not set field '{}' with value '{}'".format(
                         fieldname, value))
 
-        # All reference fields are set. We can set the proxy fields now.
-        for pf in proxy_fields:
-            field_name = pf.get("field_name")
-            fm = pf.get("fm")
-            value = pf.get("value")
-            try:
-                fm.set(obj, value)
-            except:
-                logger.debug(
-                    "Could not set field '{}' with value '{}'".format(
-                        field_name,
-                        value))
-
         # Set the workflow states
         wf_info = data.get("workflow_info", [])
         for wf_dict in wf_info:
@@ -543,7 +859,47 @@ class ImportStep(SyncStep):
             self._import_review_history(obj, wf_id, review_history)
 
         # finally reindex the object
-        self.uids_to_reindex.append(api.get_uid(obj))
+        self.reindex_queue.add(api.get_uid(obj))
+
+    def _set_file_field(self, obj, planned, fileinfo, version=None):
+        """
+        Gets the file from the downloader and sets it to the field of the
+        object. A copy of the cached file is handed over to the field as a
+        file object, so the blob storage reads it in chunks as well.
+        :param obj: object to be updated
+        :param planned: PlannedField of the file field
+        :param fileinfo: file information from the JSON API
+        :param version: modification date of the remote object
+        """
+        url = fileinfo.get("download")
+        path = self._get_downloader().get(url, version)
+        if path is None:
+            return
+        tmp_file = open_copy(path)
+        filename = fileinfo.get("filename")
+        mimetype = fileinfo.get("content_type")
+        try:
+            mutator = getattr(planned.field, "getMutator", None)
+            if mutator is not None:
+                mutator(obj)(tmp_file, filename=filename, mimetype=mimetype)
+            else:
+                # Field managers expect the whole file base64 encoded, while
+                # the field reads the file object in chunks
+                planned.field.set(obj, tmp_file, filename=filename,
+                                  mimetype=mimetype)
+        except Exception, e:
+            logger.error("Could not set file field '{}' of {}: {}".format(
+                         planned.name, repr(obj), e))
+        finally:
+            self._discard_file(tmp_file)
+
+    def _discard_file(self, tmp_file):
+        """ Close and remove a temporary file. The blob storage might have
+        consumed it already.
+        """
+        tmp_file.close()
+        if os.path.exists(tmp_file.name):
+            os.remove(tmp_file.name)
 
     def _create_object_slug(self, container, data, *args, **kwargs):
         """Create an content object slug for the given data
@@ -629,10 +985,9 @@ class ImportStep(SyncStep):
             logger.info('Recovering {0}/{1} : {2} '.format(
                                         idx+1, total, existing[REMOTE_PATH]))
             # Mark that update failed previously
-            existing['updated'] = '0'
-            self._handle_obj(existing, handle_dependencies=False)
-            obj = brain.getObject()
-            obj.reindexObject()
+            existing = existing.replace(updated='0')
+            self._handle_obj(existing)
+        self._flush_reindex_queue()
         return
 
     def _set_object_permission(self, obj):
@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SYNC
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+import os
+import socket
+import threading
+import time
+from datetime import datetime
+from Queue import Queue
+
+import transaction
+from AccessControl.SecurityManagement import newSecurityManager
+from AccessControl.SecurityManagement import noSecurityManager
+from AccessControl.SpecialUsers import system
+from BTrees.IOBTree import IOBTree
+from DateTime import DateTime
+from Testing.makerequest import makerequest
+from persistent import Persistent
+from persistent.mapping import PersistentMapping
+from zope.annotation.interfaces import IAnnotations
+from zope.component.hooks import setSite
+
+from senaite.sync import logger
+from senaite.sync import utils
+from senaite.sync.fetchstep import FetchStep
+from senaite.sync.importstep import ImportStep
+from senaite.sync.souphandler import SYNC_STORAGE
+from senaite.sync.updatestep import UpdateStep
+
+# Key of the job records in the portal annotations
+SYNC_JOBS = "senaite.sync.jobs"
+
+# Job states
+QUEUED = "queued"
+RUNNING = "running"
+FINISHED = "finished"
+FAILED = "failed"
+# Queued or running in a process which does not run anymore
+INTERRUPTED = "interrupted"
+
+# Steps a job can run
+STEPS = ("fetch", "resume_fetch", "import", "update")
+
+# Seconds between two heartbeats of the jobs queued or running in a process
+HEARTBEAT_INTERVAL = 60
+# Seconds without heartbeat after which a job is taken as interrupted
+HEARTBEAT_TIMEOUT = 5 * 60
+
+# Runners by portal path, one per process
+_runners = dict()
+_runners_lock = threading.Lock()
+
+
+def get_jobs(portal):
+    """
+    Get the job records of the portal. Nothing is written, so status views
+    can call it: if no job has been queued yet, an empty mapping which is
+    not stored is returned.
+    :param portal: portal object
+    :return: IOBTree of job records by job id
+    """
+    jobs = IAnnotations(portal).get(SYNC_JOBS)
+    if jobs is None:
+        return IOBTree()
+    return jobs
+
+
+def get_process_id():
+    """
+    Get the identifier of this process among the ZEO clients.
+    :return: 'hostname:pid'
+    """
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+def enqueue(portal, domain_name, step, **options):
+    """
+    Creates the record of a job running a sync step of the domain. The job is
+    handed to the runner once the current transaction is committed. Nothing
+    is queued if a job of the domain is queued or running already, so jobs
+    don't pile up, e.g. when auto sync runs more often than they take.
+    :param portal: portal object
+    :param domain_name: name of the domain
+    :param step: one of STEPS
+    :param options: options of the step, e.g. 'fetch_time' for updates
+    :return: id of the job, or of the job queued or running already
+    """
+    if step not in STEPS:
+        raise ValueError("Unknown sync step: {}".format(step))
+    active_job = get_active_job(portal, domain_name)
+    if active_job is not None:
+        logger.info("Job {} of '{}' is {} already, {} not queued".format(
+                    active_job["id"], domain_name, active_job["state"], step))
+        return active_job["id"]
+    annotation = IAnnotations(portal)
+    if annotation.get(SYNC_JOBS) is None:
+        annotation[SYNC_JOBS] = IOBTree()
+    jobs = annotation[SYNC_JOBS]
+    job_id = jobs.maxKey() + 1 if jobs else 1
+    jobs[job_id] = PersistentMapping(
+        id=job_id,
+        domain_name=domain_name,
+        step=step,
+        options=dict(options),
+        state=QUEUED,
+        created=DateTime(),
+        started=None,
+        finished=None,
+        error=None,
+        progress=None,
+        heartbeat=Heartbeat(),
+    )
+    runner = get_runner(portal)
+    transaction.get().addAfterCommitHook(runner.on_commit, args=(job_id, ))
+    logger.info("Job {} queued: {} of '{}'".format(job_id, step, domain_name))
+    return job_id
+
+
+def get_active_job(portal, domain_name):
+    """
+    Get the job of the domain which is queued or running, if any.
+    :param portal: portal object
+    :param domain_name: name of the domain
+    :return: job record or None
+    """
+    for job in get_jobs(portal).values():
+        if job["domain_name"] != domain_name:
+            continue
+        if job["state"] in (QUEUED, RUNNING) and \
+                not is_interrupted(portal, job):
+            return job
+    return None
+
+
+def get_runner(portal):
+    """
+    Get the runner of the portal's jobs in this process.
+    :param portal: portal object
+    :return: JobRunner
+    """
+    portal_path = "/".join(portal.getPhysicalPath())
+    with _runners_lock:
+        runner = _runners.get(portal_path)
+        if runner is None:
+            runner = JobRunner(portal._p_jar.db(), portal_path)
+            _runners[portal_path] = runner
+    return runner
+
+
+def get_job_info(portal, job):
+    """
+    Get the status of the job, with the live progress if it is running in
+    this process. Jobs of other processes are taken as interrupted once
+    their heartbeat is stale.
+    :param portal: portal object
+    :param job: job record
+    :return: dictionary with the job data, 'owner' (process the job is
+             queued in), 'processed', 'total', 'percentage', 'throughput'
+             (items per second) and 'eta'
+    """
+    info = dict(job)
+    runner = get_runner(portal)
+    progress = runner.get_progress(job["id"]) or job.get("progress") or {}
+    heartbeat = job.get("heartbeat")
+    info["owner"] = heartbeat and heartbeat.owner
+    if is_interrupted(portal, job):
+        info["state"] = INTERRUPTED
+    processed = progress.get("processed", 0)
+    total = progress.get("total", 0)
+    started = progress.get("started")
+    info.update(task=progress.get("task"), processed=processed, total=total,
+                percentage=None, throughput=None, eta=None)
+    if total > 0:
+        info["percentage"] = processed * 100.0 / total
+    if started and processed > 0:
+        elapsed = (datetime.now() - started).total_seconds()
+        if elapsed > 0:
+            info["throughput"] = processed / elapsed
+        info["eta"] = utils.get_estimated_end_date(started, processed, total)
+    return info
+
+
+def is_interrupted(portal, job):
+    """
+    Whether the job is queued or running in a process which does not run it
+    anymore, i.e. neither this process runs it nor its heartbeat is recent.
+    :param portal: portal object
+    :param job: job record
+    """
+    if job["state"] not in (QUEUED, RUNNING):
+        return False
+    if get_runner(portal).is_active(job["id"]):
+        return False
+    heartbeat = job.get("heartbeat")
+    return heartbeat is None or heartbeat.is_stale()
+
+
+class Heartbeat(Persistent):
+    """
+    Last sign of life of the process a job is queued or running in. It is
+    kept apart from the job record, so refreshing it never conflicts with
+    the updates of the job.
+    """
+
+    def __init__(self):
+        self.owner = get_process_id()
+        self.time = DateTime()
+
+    def beat(self):
+        self.time = DateTime()
+
+    def is_stale(self):
+        elapsed = (DateTime() - self.time) * 24 * 60 * 60
+        return elapsed > HEARTBEAT_TIMEOUT
+
+
+class JobRunner(object):
+    """
+    Runs the sync jobs of a portal one after the other in a background
+    thread, with its own connection to the database, so requests only queue
+    them and return at once.
+    """
+
+    def __init__(self, db, portal_path):
+        self.db = db
+        self.portal_path = portal_path
+        self._queue = Queue()
+        self._thread = None
+        self._heartbeat_thread = None
+        self._lock = threading.Lock()
+        # Ids of the jobs queued or running in this process
+        self._active = set()
+        # Live progress of the jobs by id, as reported by log_process
+        self._progress = dict()
+
+    def on_commit(self, status, job_id):
+        """ After commit hook of the transaction which created the job
+        """
+        if not status:
+            return
+        self.submit(job_id)
+
+    def submit(self, job_id):
+        """
+        Queues the job, starting the worker thread if necessary.
+        :param job_id: id of a committed job record
+        """
+        with self._lock:
+            self._active.add(job_id)
+            self._queue.put(job_id)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._work,
+                                                name="senaite.sync.jobs")
+                self._thread.daemon = True
+                self._thread.start()
+            if self._heartbeat_thread is None or \
+                    not self._heartbeat_thread.is_alive():
+                self._heartbeat_thread = threading.Thread(
+                    target=self._beat, name="senaite.sync.jobs.heartbeat")
+                self._heartbeat_thread.daemon = True
+                self._heartbeat_thread.start()
+
+    def is_active(self, job_id):
+        return job_id in self._active
+
+    def get_progress(self, job_id):
+        return self._progress.get(job_id)
+
+    def _work(self):
+        """ Worker thread loop
+        """
+        while True:
+            job_id = self._queue.get()
+            try:
+                self._run(job_id)
+            except Exception, e:
+                logger.error("Job {} could not be run: {}".format(job_id, e))
+            finally:
+                with self._lock:
+                    self._active.discard(job_id)
+
+    def _beat(self):
+        """
+        Heartbeat thread loop, refreshing the heartbeats of the jobs queued
+        or running in this process, so other processes don't take them as
+        interrupted.
+        """
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            with self._lock:
+                job_ids = list(self._active)
+            if not job_ids:
+                continue
+            conn = self.db.open()
+            try:
+                transaction.begin()
+                app = makerequest(conn.root()["Application"])
+                portal = app.unrestrictedTraverse(self.portal_path)
+                jobs = get_jobs(portal)
+                for job_id in job_ids:
+                    job = jobs.get(job_id)
+                    if job is not None and job.get("heartbeat") is not None:
+                        job["heartbeat"].beat()
+                transaction.commit()
+            except Exception, e:
+                logger.warning("Heartbeat of jobs {} failed: {}".format(
+                               job_ids, e))
+            finally:
+                transaction.abort()
+                conn.close()
+
+    def _run(self, job_id):
+        """
+        Runs the job within its own connection, site and security context.
+        Steps commit their work themselves; the job record is updated before
+        and after the step.
+        """
+        conn = self.db.open()
+        try:
+            app = makerequest(conn.root()["Application"])
+            portal = app.unrestrictedTraverse(self.portal_path)
+            setSite(portal)
+            newSecurityManager(None, system)
+            transaction.begin()
+            job = get_jobs(portal)[job_id]
+            job["state"] = RUNNING
+            job["started"] = DateTime()
+            transaction.commit()
+            utils.set_progress_hook(self._get_progress_hook(job_id))
+            logger.info("Job {} started: {} of '{}'".format(
+                        job_id, job["step"], job["domain_name"]))
+            try:
+                run_step(portal, job["domain_name"], job["step"],
+                         **job["options"])
+            except Exception, e:
+                transaction.abort()
+                logger.error("Job {} failed: {}".format(job_id, e))
+                self._finish(portal, job_id, FAILED, error=str(e))
+            else:
+                self._finish(portal, job_id, FINISHED)
+        finally:
+            utils.set_progress_hook(None)
+            noSecurityManager()
+            setSite(None)
+            transaction.abort()
+            conn.close()
+
+    def _finish(self, portal, job_id, state, error=None):
+        """ Stores the final state and progress of the job
+        """
+        job = get_jobs(portal)[job_id]
+        job["state"] = state
+        job["finished"] = DateTime()
+        job["error"] = error
+        job["progress"] = self._progress.get(job_id)
+        transaction.commit()
+        logger.info("Job {} {}".format(job_id, state))
+
+    def _get_progress_hook(self, job_id):
+        def hook(task_name, started, processed, total):
+            self._progress[job_id] = dict(task=task_name, started=started,
+                                          processed=processed, total=total)
+        return hook
+
+
+def run_step(portal, domain_name, step, config=None, fetch_time=None):
+    """
+    Runs a sync step of the domain.
+    :param portal: portal object
+    :param domain_name: name of the domain
+    :param step: one of STEPS
+    :param config: configuration values overriding the domain's ones
+    :param fetch_time: date the objects must be modified since, for updates.
+                       The last fetch time of the domain if not given
+    """
+    storage = IAnnotations(portal)[SYNC_STORAGE][domain_name]
+    credentials = storage["credentials"]
+    configuration = dict(storage["configuration"].items())
+    configuration.update(config or {})
+    if step == "fetch":
+        FetchStep(credentials, configuration).run()
+    elif step == "resume_fetch":
+        FetchStep(credentials, configuration).run(resume=True)
+    elif step == "import":
+        ImportStep(credentials, configuration).run()
+    elif step == "update":
+        fetch_time = fetch_time or storage.get("last_fetch_time")
+        UpdateStep(credentials, configuration, fetch_time).run()
+    else:
+        raise ValueError("Unknown sync step: {}".format(step))
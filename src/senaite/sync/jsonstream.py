@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SYNC
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+import codecs
+import json
+
+WHITESPACE = u" \t\n\r"
+
+# Characters which may continue a number
+NUMBER_CHARS = u"0123456789.eE+-"
+
+_decoder = json.JSONDecoder()
+
+
+class ItemStream(object):
+    """
+    Decodes a JSON object from a stream of chunks and yields the elements of
+    one of its lists as soon as each of them is complete, so the whole
+    document is never kept in memory. The other values of the object are
+    collected in 'data' and are complete once the stream is exhausted.
+    """
+
+    def __init__(self, chunks, key="items", close=None):
+        """
+        :param chunks: iterable of encoded (utf-8) chunks of the document
+        :param key: key of the list whose elements are yielded
+        :param close: function to be called once the stream is consumed
+        """
+        self.key = key
+        self.data = dict()
+        # Whether the document contained the list
+        self.found = False
+        self._chunks = iter(chunks)
+        self._close = close
+        self._text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = u""
+        self._pos = 0
+        self._exhausted = False
+
+    def __iter__(self):
+        try:
+            for item in self._parse():
+                yield item
+        finally:
+            if self._close is not None:
+                self._close()
+
+    def _parse(self):
+        # Nothing to decode, e.g. the request failed
+        if self._peek() is None:
+            return
+        self._expect(u"{")
+        if self._peek() == u"}":
+            self._pos += 1
+            return
+        while True:
+            key = self._value()
+            self._expect(u":")
+            if key == self.key and self._peek() == u"[":
+                self._pos += 1
+                self.found = True
+                for item in self._list():
+                    yield item
+            else:
+                self.data[key] = self._value()
+            if self._expect(u",}") == u"}":
+                return
+
+    def _list(self):
+        """ Yield the elements of the list the buffer is positioned in
+        """
+        if self._peek() == u"]":
+            self._pos += 1
+            return
+        while True:
+            yield self._value()
+            if self._expect(u",]") == u"]":
+                return
+
+    def _read(self):
+        """
+        Appends the next chunk to the buffer, dropping what has been decoded.
+        :return: False if the stream is exhausted
+        """
+        if self._exhausted:
+            return False
+        self._buffer = self._buffer[self._pos:]
+        self._pos = 0
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            self._exhausted = True
+            self._buffer += self._text_decoder.decode("", final=True)
+            return False
+        self._buffer += self._text_decoder.decode(chunk)
+        return True
+
+    def _peek(self):
+        """
+        Skips whitespace.
+        :return: the next character or None at the end of the stream
+        """
+        while True:
+            while self._pos < len(self._buffer) and \
+                    self._buffer[self._pos] in WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._read():
+                return None
+
+    def _expect(self, chars):
+        """ Consume one of the given characters
+        """
+        char = self._peek()
+        if char is None or char not in chars:
+            raise ValueError("Expected one of '{}' but got {!r}".format(
+                             chars, char))
+        self._pos += 1
+        return char
+
+    def _value(self):
+        """
+        Decodes the next value, reading chunks until it is complete. A number
+        may continue in the next chunk (e.g. '7.' and '5'), so a value is only
+        taken once a character follows it which cannot be part of a number.
+        """
+        self._peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self._buffer, self._pos)
+                if self._exhausted or (end < len(self._buffer) and
+                                       self._buffer[end] not in NUMBER_CHARS):
+                    self._pos = end
+                    return value
+            except ValueError:
+                if self._exhausted:
+                    raise
+            self._read()
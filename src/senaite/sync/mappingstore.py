@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SYNC
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+from BTrees.IOBTree import IOBTree
+from BTrees.Length import Length
+from BTrees.OIBTree import OIBTree
+from BTrees.OOBTree import OOBTree
+from persistent import Persistent
+
+from senaite import api
+from senaite.sync import logger
+from senaite.sync.souphandler import COLUMNS
+from senaite.sync.souphandler import DEFAULTS
+from senaite.sync.souphandler import GENERATION
+from senaite.sync.souphandler import LOCAL_UID
+from senaite.sync.souphandler import REMOTE_PATH
+from senaite.sync.souphandler import REC_ID
+from senaite.sync.souphandler import REMOTE_UID
+from senaite.sync.souphandler import Row
+from senaite.sync.souphandler import SoupHandler
+from senaite.sync.souphandler import UNIQUE_COLUMNS
+from senaite.sync.souphandler import UPDATED
+from senaite.sync.souphandler import delete_soup
+from senaite.sync.souphandler import get_domain_storage
+from senaite.sync.souphandler import get_generation
+
+# Key of the mapping table in the domain storage
+MAPPING = "mapping"
+
+
+class MappingStorage(Persistent):
+    """
+    The mapping table of a domain. Records are tuples of column values kept
+    in an IOBTree by their ids, and each unique column has its own OIBTree
+    mapping values to record ids, so no catalog is needed. Tuples are pickled
+    within the buckets of the tree instead of being persistent objects on
+    their own, which keeps the records as compact as possible.
+    """
+
+    def __init__(self):
+        self.data = IOBTree()
+        self.indexes = OOBTree()
+        for column in UNIQUE_COLUMNS:
+            self.indexes[column] = OIBTree()
+        self.length = Length()
+
+    def __len__(self):
+        return self.length()
+
+    def get(self, rec_id, default=None):
+        """
+        :param rec_id: id of the record
+        :return: tuple of column values
+        """
+        return self.data.get(rec_id, default)
+
+    def get_id(self, column, value):
+        """
+        :param column: one of the unique columns
+        :param value: value of the column
+        :return: id of the record with the value or None
+        """
+        return self.indexes[column].get(value)
+
+    def add(self, values, rec_id=None):
+        """
+        Adds a record.
+        :param values: tuple of column values
+        :param rec_id: id of the record, the next one if not given
+        :return: id of the record
+        """
+        if rec_id is None:
+            rec_id = self.data.maxKey() + 1 if self.data else 1
+        self.data[rec_id] = values
+        self.length.change(1)
+        self._index(rec_id, values)
+        return rec_id
+
+    def add_many(self, values_list):
+        """
+        Adds several records with consecutive ids.
+        :param values_list: list of tuples of column values
+        :return: list with the id of each record
+        """
+        start = self.data.maxKey() + 1 if self.data else 1
+        rec_ids = range(start, start + len(values_list))
+        for rec_id, values in zip(rec_ids, values_list):
+            self.data[rec_id] = values
+            self._index(rec_id, values)
+        self.length.change(len(values_list))
+        return rec_ids
+
+    def set(self, rec_id, values):
+        """
+        Replaces the values of an existing record.
+        :param rec_id: id of the record
+        :param values: tuple of column values
+        """
+        self._unindex(rec_id, self.data[rec_id])
+        self.data[rec_id] = values
+        self._index(rec_id, values)
+
+    def _index(self, rec_id, values):
+        for column in UNIQUE_COLUMNS:
+            value = values[COLUMNS.index(column)]
+            if value:
+                self.indexes[column][value] = rec_id
+
+    def _unindex(self, rec_id, values):
+        for column in UNIQUE_COLUMNS:
+            value = values[COLUMNS.index(column)]
+            index = self.indexes[column]
+            if value and index.get(value) == rec_id:
+                del index[value]
+
+
+class MappingHandler(object):
+    """
+    Interacts with the mapping table of a domain. It has the same API as
+    SoupHandler, but lookups and updates go straight to the BTrees instead of
+    evaluating catalog queries.
+    """
+
+    def __init__(self, domain_name):
+        self.domain_name = domain_name
+        self.portal = api.get_portal()
+        domain_storage = get_domain_storage(self.portal, domain_name)
+        self.mapping = domain_storage[MAPPING]
+        # Records holding the current generation have been updated
+        self._generation = get_generation(domain_storage)
+
+    def insert(self, data):
+        """
+        Inserts a row to the mapping table.
+        :param data: row dictionary
+        :return: id of created record
+        """
+        if self._already_exists(data):
+            logger.debug("Trying to insert existing record... {}".format(data))
+            return False
+        r_id = self.mapping.add(to_values(data))
+        logger.debug("Record {} inserted: {}".format(r_id, data))
+        return r_id
+
+    def bulk_insert(self, rows):
+        """
+        Inserts several rows to the mapping table. Rows which already exist,
+        in the table or earlier in the same batch, are skipped. The whole
+        batch is checked before any record is written.
+        :param rows: iterable of row dictionaries
+        :return: list with the id of the created record for each row, or
+                 False for the skipped ones
+        """
+        # Unique values of the rows of the batch to be inserted
+        batch_values = dict((column, set()) for column in UNIQUE_COLUMNS)
+        new_values = []
+        positions = []
+        rec_ids = []
+        for data in rows:
+            unique_values = [(column, data.get(column))
+                             for column in UNIQUE_COLUMNS if data.get(column)]
+            if self._already_exists(data) or any(
+                    value in batch_values[column]
+                    for column, value in unique_values):
+                logger.debug("Trying to insert existing record... {}"
+                             .format(data))
+                rec_ids.append(False)
+                continue
+            for column, value in unique_values:
+                batch_values[column].add(value)
+            positions.append(len(rec_ids))
+            rec_ids.append(False)
+            new_values.append(to_values(data))
+
+        for position, rec_id in zip(positions,
+                                    self.mapping.add_many(new_values)):
+            rec_ids[position] = rec_id
+        if new_values:
+            logger.info("{} records inserted".format(len(new_values)))
+        return rec_ids
+
+    def get_records(self):
+        """
+        Iterates over all the records of the table.
+        :return: generator of Rows
+        """
+        for rec_id, values in self.mapping.data.iteritems():
+            yield Row(rec_id, values)
+
+    def get_record_by_id(self, rec_id, as_dict=False):
+        values = self.mapping.get(rec_id)
+        if values is None:
+            return None
+        return Row(rec_id, values)
+
+    def find_unique(self, column, value):
+        """
+        Gets the record row by the given column and value.
+        :param column: one of the unique columns
+        :param value: column value
+        :return: Row
+        """
+        rec_id = self.mapping.get_id(column, value)
+        if rec_id is None:
+            return None
+        return self.get_record_by_id(rec_id)
+
+    def get_local_uid(self, r_uid):
+        """
+        Get the local uid by remote uid
+        :param r_uid: remote uid of the row
+        :return: local uid from the row
+        """
+        rec_id = self.mapping.get_id(REMOTE_UID, r_uid)
+        if rec_id is None:
+            return None
+        return self.mapping.get(rec_id)[COLUMNS.index(LOCAL_UID)]
+
+    def update_by_remote_uid(self, remote_uid, **kwargs):
+        """
+        Update the row by remote_uid column.
+        :param remote_uid: UID of the object in the source
+        :param kwargs: columns and their values to be updated.
+        """
+        rec_id = self.mapping.get_id(REMOTE_UID, remote_uid)
+        if rec_id is None:
+            logger.error("Could not find any record with remote_uid: '{}'"
+                         .format(remote_uid))
+            return False
+        self._update_record(rec_id, kwargs)
+        return True
+
+    def update_by_remote_path(self, remote_path, **kwargs):
+        """
+        Update the row by path column.
+        :param path: path of the record
+        :param kwargs: columns and their values to be updated.
+        """
+        rec_id = self.mapping.get_id(REMOTE_PATH, remote_path)
+        if rec_id is None:
+            logger.error("Could not find any record with path: '{}'"
+                         .format(remote_path))
+            return False
+        self._update_record(rec_id, kwargs)
+        return True
+
+    def mark_update(self, remote_uid, **kwargs):
+        """
+        Marks that record's object has been updated, stamping the record with
+        the current generation.
+        :param kwargs: other columns to be updated at once
+        """
+        kwargs[UPDATED] = str(self._generation)
+        return self.update_by_remote_uid(remote_uid, **kwargs)
+
+    def is_updated(self, row):
+        """
+        Checks if the row's object has been updated in the current generation.
+        :param row: record dictionary
+        :return: True if updated
+        """
+        return row.get(UPDATED, "0") == str(self._generation)
+
+    def reset_updated_flags(self):
+        """
+        Marks all the records as non-updated by starting a new generation.
+        :return:
+        """
+        storage = get_domain_storage(self.portal, self.domain_name)
+        self._generation += 1
+        storage[GENERATION] = self._generation
+        return True
+
+    def _update_record(self, rec_id, values):
+        """
+        Sets the column values of the record.
+        :param rec_id: id of the record
+        :param values: dictionary of columns and their new values
+        """
+        row = Row(rec_id, self.mapping.get(rec_id)).replace(**values)
+        self.mapping.set(rec_id, row.column_values)
+
+    def _already_exists(self, data):
+        """
+        Checks if the record already exists.
+        :param data: row dictionary
+        :return: True or False
+        """
+        for column in UNIQUE_COLUMNS:
+            value = data.get(column)
+            if value and self.mapping.get_id(column, value) is not None:
+                return True
+        return False
+
+
+def to_values(data):
+    """
+    :param data: row dictionary
+    :return: tuple of column values to be stored
+    """
+    return tuple([data.get(column) or default
+                  for column, default in zip(COLUMNS, DEFAULTS)])
+
+
+def get_mapping_handler(domain_name):
+    """
+    Get the handler of the domain's mapping table. Domains whose table has
+    not been migrated from a soup yet keep using the SoupHandler.
+    :param domain_name: name of the domain
+    :return: MappingHandler or SoupHandler
+    """
+    storage = get_domain_storage(api.get_portal(), domain_name)
+    if storage is not None and MAPPING in storage:
+        return MappingHandler(domain_name)
+    return SoupHandler(domain_name)
+
+
+def migrate_soup(portal, domain_name):
+    """
+    Moves the records of the domain's soup to a new mapping table, keeping
+    their ids, and clears the soup.
+    :param portal: portal object
+    :param domain_name: name of the domain
+    :return: True if the domain was migrated
+    """
+    domain_storage = get_domain_storage(portal, domain_name)
+    if domain_storage is None or MAPPING in domain_storage:
+        return False
+    mapping = MappingStorage()
+    for row in SoupHandler(domain_name).get_records():
+        mapping.add(row.column_values, rec_id=row[REC_ID])
+    domain_storage[MAPPING] = mapping
+    delete_soup(portal, domain_name)
+    logger.info("Migrated {} records of '{}' to the mapping table".format(
+                len(mapping), domain_name))
+    return True
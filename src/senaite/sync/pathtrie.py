@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SYNC
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+
+class PathNode(object):
+    """
+    A node of the PathTrie: a remote path with the portal type of its object
+    and its translated local path, if known.
+    """
+    __slots__ = ("children", "portal_type", "local_path", "known")
+
+    def __init__(self):
+        self.children = dict()
+        self.portal_type = None
+        self.local_path = None
+        # Whether the path has been added or the node is just an ancestor
+        self.known = False
+
+
+class PathTrie(object):
+    """
+    Keeps remote paths in memory segment by segment, so the information of
+    a path and all its parents can be looked up without any catalog query.
+    """
+
+    def __init__(self):
+        self._root = PathNode()
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def __contains__(self, path):
+        return self.get(path) is not None
+
+    def add(self, path, portal_type=None, local_path=None):
+        """
+        Adds the path to the trie, or updates its information if it is in the
+        trie already.
+        :param path: remote path
+        :param portal_type: portal type of the object
+        :param local_path: translated local path, if known
+        :return: the PathNode of the path
+        """
+        node = self._root
+        for segment in split_path(path):
+            child = node.children.get(segment)
+            if child is None:
+                child = PathNode()
+                node.children[segment] = child
+            node = child
+        if not node.known:
+            node.known = True
+            self._length += 1
+        if portal_type is not None:
+            node.portal_type = portal_type
+        if local_path:
+            node.local_path = local_path
+        return node
+
+    def get(self, path):
+        """
+        :param path: remote path
+        :return: the PathNode of the path or None if it was not added
+        """
+        node = self._root
+        for segment in split_path(path):
+            node = node.children.get(segment)
+            if node is None:
+                return None
+        if not node.known:
+            return None
+        return node
+
+
+def split_path(path):
+    """
+    :param path: a physical path, e.g. '/senaite/clients/client-1'
+    :return: list of the path's segments
+    """
+    return [segment for segment in path.split("/") if segment]
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SYNC
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+from collections import OrderedDict
+
+from senaite import api
+from senaite.sync import logger
+
+# Stands for the computed indexes of the object in the indexes to update, see
+# 'get_computed_index_names'
+COMPUTED_INDEXES = "computed_indexes"
+
+
+class ReindexQueue(object):
+    """
+    Collects the local UIDs of the objects to be reindexed, so each object is
+    reindexed only once per commit, no matter how many times it was added.
+    """
+
+    def __init__(self):
+        # UID: set of index names, or None to reindex all the indexes
+        self._queue = OrderedDict()
+        # UIDs of the objects whose modification date must be kept
+        self._keep_modified = set()
+        # Number of times an object was added to the queue
+        self.requested = 0
+        # Number of objects reindexed
+        self.reindexed = 0
+        # Names of the computed indexes by portal type
+        self._computed_indexes = dict()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def __contains__(self, uid):
+        return uid in self._queue
+
+    @property
+    def saved(self):
+        """
+        :return: number of reindexes saved by deduplicating the objects
+        """
+        return self.requested - self.reindexed - len(self)
+
+    def add(self, uid, idxs=None, keep_modified=False):
+        """
+        Adds the object to the queue. Indexes are merged with the ones of
+        previous additions of the same object.
+        :param uid: local UID of the object
+        :param idxs: names of the indexes to be updated, all if None. It may
+                     contain COMPUTED_INDEXES
+        :param keep_modified: do not let the reindex change the object's
+                              modification date
+        """
+        if not uid:
+            return
+        self.requested += 1
+        if keep_modified:
+            self._keep_modified.add(uid)
+        if uid not in self._queue:
+            self._queue[uid] = None if idxs is None else set(idxs)
+            return
+        current = self._queue[uid]
+        if current is None or idxs is None:
+            self._queue[uid] = None
+        else:
+            current.update(idxs)
+
+    def flush(self):
+        """
+        Reindexes the queued objects and empties the queue. Must be called
+        before committing the transaction.
+        :return: number of objects reindexed
+        """
+        count = len(self._queue)
+        for uid, idxs in self._queue.iteritems():
+            # It is possible that the object has a method (not a Field
+            # in its Schema) which is used as an index and it fails.
+            try:
+                obj = api.get_object_by_uid(uid)
+                if idxs and COMPUTED_INDEXES in idxs:
+                    idxs = idxs - {COMPUTED_INDEXES}
+                    idxs.update(self._get_computed_indexes(obj))
+                    if not idxs:
+                        continue
+                # Archetypes updates the modification date when all the
+                # indexes are reindexed, unless they are given explicitly
+                if not idxs and uid in self._keep_modified:
+                    idxs = get_index_names(obj)
+                if idxs:
+                    obj.reindexObject(idxs=sorted(idxs))
+                else:
+                    obj.reindexObject()
+            except Exception, e:
+                logger.error("Error while reindexing {} - {}".format(uid, e))
+        self._queue.clear()
+        self._keep_modified.clear()
+        self.reindexed += count
+        return count
+
+    def _get_computed_indexes(self, obj):
+        """ Get the computed indexes of the object, cached by portal type
+        """
+        portal_type = api.get_portal_type(obj)
+        names = self._computed_indexes.get(portal_type)
+        if names is None:
+            names = get_computed_index_names(obj)
+            self._computed_indexes[portal_type] = names
+        return names
+
+
+def get_index_names(obj):
+    """
+    :param obj: content object
+    :return: names of the indexes of all the catalogs the object is in
+    """
+    names = set()
+    for catalog in api.get_catalogs_for(obj):
+        names.update(catalog.indexes())
+    return names
+
+
+def get_computed_index_names(obj):
+    """
+    Get the indexes which are not fed by the schema fields of the object,
+    i.e. by methods which may depend on other objects, e.g. on the objects
+    referencing this one.
+    :param obj: content object
+    :return: names of the indexes of all the catalogs the object is in
+    """
+    field_attributes = set()
+    for name, field in api.get_fields(obj).items():
+        field_attributes.add(name)
+        for attribute in ("accessor", "edit_accessor"):
+            accessor = getattr(field, attribute, None)
+            if accessor:
+                field_attributes.add(accessor)
+    names = set()
+    for catalog in api.get_catalogs_for(obj):
+        for index in catalog.getIndexObjects():
+            get_sources = getattr(index, "getIndexSourceNames", None)
+            sources = get_sources and get_sources() or [index.getId()]
+            if not field_attributes.issuperset(sources):
+                names.add(index.getId())
+    return names
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SYNC
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+"""Runs a sync step of a domain without the publisher.
+
+As a zopectl command:
+
+    bin/instance sync --site senaite --domain remote --step import
+
+Or as a script:
+
+    bin/instance run src/senaite/sync/run.py --site senaite --domain remote \\
+        --step import
+"""
+
+import argparse
+import json
+import sys
+from datetime import datetime
+
+import transaction
+from AccessControl.SecurityManagement import newSecurityManager
+from AccessControl.SpecialUsers import system
+from DateTime import DateTime
+from Testing.makerequest import makerequest
+from zope.annotation.interfaces import IAnnotations
+from zope.component.hooks import setSite
+
+from senaite.sync import logger
+from senaite.sync import utils
+from senaite.sync.jobs import run_step
+from senaite.sync.souphandler import SYNC_STORAGE
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog="sync", description="Run a sync step of a domain")
+    parser.add_argument("--site", required=True,
+                        help="path of the site, e.g. 'senaite'")
+    parser.add_argument("--domain", required=True,
+                        help="name of the domain (remote)")
+    parser.add_argument("--step", required=True,
+                        choices=["fetch", "import", "update"])
+    parser.add_argument("--concurrency", type=int,
+                        help="number of threads fetching pages and object "
+                             "data, instead of the domain's configuration")
+    parser.add_argument("--commit-interval", type=int,
+                        help="number of imported objects per commit")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue the last fetch from its checkpoint. "
+                             "Imports always continue from their cursor")
+    parser.add_argument("--since",
+                        help="date objects must be modified since, for "
+                             "updates. Defaults to the last fetch time")
+    parser.add_argument("--json", action="store_true",
+                        help="print the progress as JSON lines")
+    return parser
+
+
+def print_json(**data):
+    """ Write a JSON line to the standard output
+    """
+    sys.stdout.write(json.dumps(data, default=str) + "\n")
+    sys.stdout.flush()
+
+
+def json_progress(task_name, started, processed, total):
+    """ Progress hook printing the progress reported by log_process
+    """
+    estimated = None
+    if processed > 0:
+        estimated = utils.get_estimated_end_date(started, processed, total)
+    print_json(event="progress", task=task_name, processed=processed,
+               total=total, started=started, eta=estimated)
+
+
+def main(app, args):
+    """
+    Entry point of the 'sync' zopectl command.
+    :param app: Zope application root
+    :param args: command line arguments
+    """
+    options = get_parser().parse_args(args)
+
+    app = makerequest(app)
+    site = app.unrestrictedTraverse(options.site, None)
+    if site is None:
+        sys.exit("No site found at '{}'".format(options.site))
+    setSite(site)
+    newSecurityManager(None, system)
+
+    storage = IAnnotations(site).get(SYNC_STORAGE) or {}
+    if options.domain not in storage:
+        sys.exit("No domain named '{}' in '{}'".format(options.domain,
+                                                       options.site))
+
+    config = dict()
+    if options.concurrency is not None:
+        config["fetch_concurrency"] = options.concurrency
+        config["import_concurrency"] = options.concurrency
+    if options.commit_interval is not None:
+        config["commit_interval"] = options.commit_interval
+
+    step = options.step
+    if step == "fetch" and options.resume:
+        step = "resume_fetch"
+    fetch_time = options.since and DateTime(options.since) or None
+
+    if options.json:
+        utils.set_progress_hook(json_progress)
+        print_json(event="started", step=step, domain=options.domain)
+    started = datetime.now()
+    try:
+        run_step(site, options.domain, step, config=config,
+                 fetch_time=fetch_time)
+        transaction.commit()
+    except Exception, e:
+        transaction.abort()
+        logger.error("Step {} of '{}' failed: {}".format(
+                     step, options.domain, e))
+        if options.json:
+            print_json(event="failed", step=step, domain=options.domain,
+                       error=str(e))
+        raise
+    finally:
+        utils.set_progress_hook(None)
+
+    if options.json:
+        elapsed = (datetime.now() - started).total_seconds()
+        print_json(event="finished", step=step, domain=options.domain,
+                   elapsed=elapsed)
+
+
+if __name__ == "__main__":
+    # 'bin/instance run' provides the application as 'app'
+    main(app, sys.argv[1:])  # noqa
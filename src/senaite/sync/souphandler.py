@@ -5,6 +5,8 @@
 # Copyright 2018 by it's authors.
 # Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
 
+import random
+
 from senaite import api
 from senaite.sync import logger
 
@@ -23,7 +25,11 @@ from repoze.catalog.catalog import Catalog
 from repoze.catalog.indexes.field import CatalogFieldIndex
 from souper.soup import Record
 from repoze.catalog.query import Eq
-from repoze.catalog.query import Or
+from zope.annotation.interfaces import IAnnotations
+
+SYNC_STORAGE = "senaite.sync"
+# Key of the current generation in the domain storage
+GENERATION = "generation"
 
 
 # SOUPER TABLE COLUMNS
@@ -33,6 +39,16 @@ LOCAL_UID = 'local_uid'
 LOCAL_PATH = 'local_path'
 PORTAL_TYPE = 'portal_type'
 UPDATED = 'updated'
+# Remote modification date of the data the object was last updated with
+REMOTE_MODIFIED = 'remote_modified'
+# Columns whose values identify a single record
+UNIQUE_COLUMNS = (REMOTE_UID, LOCAL_UID, REMOTE_PATH, LOCAL_PATH)
+# All the columns, in the order rows keep them, and their default values
+COLUMNS = (REMOTE_UID, LOCAL_UID, REMOTE_PATH, LOCAL_PATH, PORTAL_TYPE, UPDATED,
+           REMOTE_MODIFIED)
+DEFAULTS = ("", "", "", "", "", "0", "")
+# Key of the record id in rows
+REC_ID = 'rec_int_id'
 
 
 class SoupHandler:
@@ -44,6 +60,16 @@ class SoupHandler:
         self.domain_name = domain_name
         self.portal = api.get_portal()
         self.soup = self._set_soup()
+        # Maps the values of the unique columns to their records' intids.
+        # Loaded lazily, see _get_unique_index
+        self._unique_index = None
+        # Next id of bulk inserted records, see _generate_intid
+        self._next_intid = None
+        # Records whose 'updated' column holds the current generation have
+        # been updated. It is read once, so worker threads can use it without
+        # accessing the database.
+        self._generation = get_generation(
+            get_domain_storage(self.portal, domain_name))
 
     def get_soup(self):
         return self.soup
@@ -69,6 +95,71 @@ class SoupHandler:
         if self._already_exists(data):
             logger.debug("Trying to insert existing record... {}".format(data))
             return False
+        record = self._make_record(data)
+        r_id = self.soup.add(record)
+        if self._unique_index is not None:
+            self._index_unique_values(record)
+        logger.debug("Record {} inserted: {}".format(r_id, data))
+        return r_id
+
+    def bulk_insert(self, rows):
+        """
+        Inserts several rows to the soup table at once. Rows which already
+        exist, in the table or earlier in the same batch, are skipped. The
+        uniqueness of all the rows is checked against the in-memory index, the
+        records are added to the soup's storage and then cataloged in a single
+        pass.
+        :param rows: iterable of row dictionaries
+        :return: list with the intid of the created record for each row, or
+                 False for the skipped ones
+        """
+        self._get_unique_index()
+        storage = self.soup.storage
+        intids = []
+        records = []
+        for data in rows:
+            if self._already_exists(data):
+                logger.debug("Trying to insert existing record... {}"
+                             .format(data))
+                intids.append(False)
+                continue
+            record = self._make_record(data)
+            record.intid = self._generate_intid(storage.data)
+            storage.data[record.intid] = record
+            # Following rows of the batch must not clash with this one
+            self._index_unique_values(record)
+            records.append(record)
+            intids.append(record.intid)
+
+        if records:
+            storage.length.change(len(records))
+            self.soup.reindex(records)
+            logger.info("{} records inserted".format(len(records)))
+        return intids
+
+    def _generate_intid(self, data):
+        """
+        Generates a free id for a new record. Like the soup does, ids start
+        at a random value and are consecutive from there, so the records of
+        concurrent transactions don't clash.
+        :param data: IOBTree of the soup's records
+        :return: id for the record
+        """
+        while True:
+            if self._next_intid is None:
+                self._next_intid = random.randrange(0, 2 ** 31)
+            intid = self._next_intid
+            self._next_intid += 1
+            if intid not in data:
+                return intid
+            self._next_intid = None
+
+    def _make_record(self, data):
+        """
+        Creates a new record (not added to the soup) from a row.
+        :param data: row dictionary
+        :return: soup record
+        """
         record = Record()
         record.attrs[REMOTE_UID] = data[REMOTE_UID]
         record.attrs[LOCAL_UID] = data.get(LOCAL_UID, "")
@@ -76,9 +167,8 @@ class SoupHandler:
         record.attrs[LOCAL_PATH] = data.get(LOCAL_PATH, "")
         record.attrs[PORTAL_TYPE] = data[PORTAL_TYPE]
         record.attrs[UPDATED] = data.get(UPDATED, "0")
-        r_id = self.soup.add(record)
-        logger.info("Record {} inserted: {}".format(r_id, data))
-        return r_id
+        record.attrs[REMOTE_MODIFIED] = data.get(REMOTE_MODIFIED, "")
+        return record
 
     def _already_exists(self, data):
         """
@@ -86,16 +176,67 @@ class SoupHandler:
         :param data: row dictionary
         :return: True or False
         """
-        r_uid = data.get(REMOTE_UID, False) or '-1'
-        l_uid = data.get(LOCAL_UID, False) or '-1'
-        r_path = data.get(REMOTE_PATH, False) or '-1'
-        l_path = data.get(LOCAL_PATH, False) or '-1'
-        r_uid_q = Eq(REMOTE_UID, r_uid)
-        l_uid_q = Eq(LOCAL_UID, l_uid)
-        r_p_q = Eq(REMOTE_PATH, r_path)
-        l_p_q = Eq(LOCAL_PATH, l_path)
-        ret = [r for r in self.soup.query(Or(r_uid_q, l_uid_q, r_p_q, l_p_q))]
-        return ret != []
+        index = self._get_unique_index()
+        for column in UNIQUE_COLUMNS:
+            value = data.get(column)
+            if value and value in index[column]:
+                return True
+        return False
+
+    def _get_unique_index(self):
+        """
+        Returns the index of the unique columns. It is loaded from the soup
+        the first time and kept in step with inserts and updates afterwards,
+        so uniqueness checks don't need to query the catalog.
+        :return: dictionary of {column: {value: intid}}
+        """
+        if self._unique_index is None:
+            self._unique_index = dict((c, {}) for c in UNIQUE_COLUMNS)
+            for record in self.soup.data.values():
+                self._index_unique_values(record)
+        return self._unique_index
+
+    def _index_unique_values(self, record):
+        """
+        Adds the unique column values of the record to the index.
+        """
+        for column in UNIQUE_COLUMNS:
+            value = record.attrs.get(column)
+            if value:
+                self._unique_index[column][value] = record.intid
+
+    def _unindex_unique_values(self, record):
+        """
+        Removes the unique column values of the record from the index.
+        """
+        for column in UNIQUE_COLUMNS:
+            values = self._unique_index[column]
+            value = record.attrs.get(column)
+            if value and values.get(value) == record.intid:
+                del values[value]
+
+    def _update_record(self, record, values):
+        """
+        Sets the column values of the record and reindexes it.
+        :param record: soup record
+        :param values: dictionary of columns and their new values
+        """
+        if self._unique_index is not None:
+            self._unindex_unique_values(record)
+        for k, v in values.iteritems():
+            record.attrs[k] = v
+        if self._unique_index is not None:
+            self._index_unique_values(record)
+        self.soup.reindex([record])
+
+    def get_records(self):
+        """
+        Iterates over all the records of the soup, without querying the
+        catalog.
+        :return: generator of record dictionaries
+        """
+        for record in self.soup.data.values():
+            yield record_to_row(record)
 
     def get_record_by_id(self, rec_id, as_dict=False):
         try:
@@ -103,7 +244,7 @@ class SoupHandler:
         except KeyError:
             return None
         if as_dict:
-            record = record_to_dict(record)
+            record = record_to_row(record)
         return record
 
     def find_unique(self, column, value):
@@ -115,7 +256,7 @@ class SoupHandler:
         """
         recs = [r for r in self.soup.query(Eq(column, value))]
         if recs:
-            return record_to_dict(recs[0])
+            return record_to_row(recs[0])
         return None
 
     def get_local_uid(self, r_uid):
@@ -126,7 +267,7 @@ class SoupHandler:
         """
         recs = [r for r in self.soup.query(Eq(REMOTE_UID, r_uid))]
         if recs and len(recs) == 1:
-            return record_to_dict(recs[0])[LOCAL_UID]
+            return recs[0].attrs.get(LOCAL_UID, "")
         return None
 
     def update_by_remote_uid(self, remote_uid, **kwargs):
@@ -140,9 +281,7 @@ class SoupHandler:
             logger.error("Could not find any record with remote_uid: '{}'"
                          .format(remote_uid))
             return False
-        for k, v in kwargs.iteritems():
-            recs[0].attrs[k] = v
-        self.soup.reindex([recs[0]])
+        self._update_record(recs[0], kwargs)
         return True
 
     def update_by_remote_path(self, remote_path, **kwargs):
@@ -156,33 +295,47 @@ class SoupHandler:
             logger.error("Could not find any record with path: '{}'"
                          .format(REMOTE_PATH))
             return False
-        for k, v in kwargs.iteritems():
-            recs[0].attrs[k] = v
-        self.soup.reindex([recs[0]])
+        self._update_record(recs[0], kwargs)
         return True
 
-    def mark_update(self, remote_uid):
+    def mark_update(self, remote_uid, **kwargs):
         """
-        Marks that record's object has been updated.
+        Marks that record's object has been updated, stamping the record with
+        the current generation.
+        :param kwargs: other columns to be updated at once
         """
         recs = [r for r in self.soup.query(Eq(REMOTE_UID, remote_uid))]
         if not recs:
             logger.error("Could not find any record with remote_uid: '{}'"
                          .format(remote_uid))
             return False
-        recs[0].attrs[UPDATED] = "1"
+        for column, value in kwargs.iteritems():
+            recs[0].attrs[column] = value
+        recs[0].attrs[UPDATED] = str(self._generation)
         self.soup.reindex([recs[0]])
         return True
 
+    def is_updated(self, row):
+        """
+        Checks if the row's object has been updated in the current generation.
+        :param row: record dictionary
+        :return: True if updated
+        """
+        return row.get(UPDATED, "0") == str(self._generation)
+
     def reset_updated_flags(self):
         """
-        Set all updated values to '0'
+        Marks all the records as non-updated by starting a new generation, so
+        no record has to be written.
         :return:
         """
-        for intid in self.soup.data:
-            rec = self.soup.get(intid)
-            rec.attrs[UPDATED] = "0"
-        self.soup.reindex()
+        storage = get_domain_storage(self.portal, self.domain_name)
+        if storage is None:
+            logger.error("No storage found for domain: '{}'".format(
+                         self.domain_name))
+            return False
+        self._generation += 1
+        storage[GENERATION] = self._generation
         return True
 
     def _create_domain_catalog(self):
@@ -230,22 +383,102 @@ class SoupHandler:
     provideAdapter(StorageLocator, adapts=[Interface])
 
 
-def record_to_dict(record):
+def get_domain_storage(portal, domain_name):
+    """
+    Get the storage of the domain from the portal annotations
+    :param portal: portal object
+    :param domain_name: name of the domain
+    :return: the domain storage or None
+    """
+    annotations = IAnnotations(portal)
+    return annotations.get(SYNC_STORAGE, {}).get(domain_name)
+
+
+def get_generation(domain_storage):
+    """
+    Get the current generation of the domain. Records marked as updated the
+    previous way ('1') count as updated in the first generation.
+    :param domain_storage: storage of the domain
+    :return: generation number
+    """
+    if domain_storage is None:
+        return 1
+    return domain_storage.get(GENERATION, 1)
+
+
+class Row(tuple):
+    """
+    An immutable view of a record: its id followed by its column values.
+    Values are read by column name, like in a dictionary, but no dictionary
+    is built for each record.
+    """
+    __slots__ = ()
+
+    FIELDS = (REC_ID, ) + COLUMNS
+
+    def __new__(cls, rec_id, values):
+        values = tuple(values)
+        # Records stored before a column was added lack its value
+        if len(values) < len(COLUMNS):
+            values += DEFAULTS[len(values):]
+        return tuple.__new__(cls, (rec_id, ) + values)
+
+    def __getnewargs__(self):
+        return self[0], tuple(self)[1:]
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            key = _ROW_POSITIONS[key]
+        return tuple.__getitem__(self, key)
+
+    def __contains__(self, key):
+        return key in _ROW_POSITIONS
+
+    def __repr__(self):
+        return repr(self.as_dict())
+
+    def get(self, key, default=None):
+        position = _ROW_POSITIONS.get(key)
+        if position is None:
+            return default
+        return tuple.__getitem__(self, position)
+
+    def keys(self):
+        return list(self.FIELDS)
+
+    @property
+    def column_values(self):
+        """
+        :return: tuple of the column values, without the record id
+        """
+        return tuple(self)[1:]
+
+    def as_dict(self):
+        return dict(zip(self.FIELDS, self))
+
+    def replace(self, **kwargs):
+        """
+        :param kwargs: columns and their new values
+        :return: a new Row with the given values changed
+        """
+        values = list(self.column_values)
+        for column, value in kwargs.iteritems():
+            values[COLUMNS.index(column)] = value
+        return Row(self[0], values)
+
+
+_ROW_POSITIONS = dict((field, pos) for pos, field in enumerate(Row.FIELDS))
+
+
+def record_to_row(record):
     """
-    Convert the soup record to dictionary
-    :param record: to be converted
-    :return: dictionary with necessary data
+    Get the row view of the soup record
+    :param record: soup record
+    :return: Row
     """
-    ret = {
-        'rec_int_id': record.intid,
-        REMOTE_UID: record.attrs.get(REMOTE_UID, ""),
-        LOCAL_UID: record.attrs.get(LOCAL_UID, ""),
-        REMOTE_PATH: record.attrs.get(REMOTE_PATH, ""),
-        LOCAL_PATH: record.attrs.get(LOCAL_PATH, ""),
-        UPDATED: record.attrs.get(UPDATED, "0"),
-        PORTAL_TYPE: record.attrs.get(PORTAL_TYPE, "")
-    }
-    return ret
+    attrs = record.attrs
+    return Row(record.intid, [attrs.get(column, default)
+                              for column, default in zip(COLUMNS, DEFAULTS)])
 
 
 def delete_soup(portal, domain_name):
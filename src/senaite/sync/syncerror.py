@@ -19,7 +19,9 @@ class SyncError(Exception):
 
     def setStatus(self, status):
         request = getRequest()
-        request.response.setStatus(status)
+        # There is no request in worker and job threads
+        if request is not None:
+            request.response.setStatus(status)
 
     def __str__(self):
         return self.message
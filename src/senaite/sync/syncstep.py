@@ -5,10 +5,13 @@
 # Copyright 2018 by it's authors.
 # Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
 
+import threading
 import urllib
 import urlparse
 import requests
 
+from Queue import Full
+from Queue import Queue
 from time import sleep
 from DateTime import DateTime
 
@@ -17,8 +20,13 @@ from zope.annotation.interfaces import IAnnotations
 from senaite import api
 from senaite.sync import logger
 from senaite.sync import utils
+from senaite.sync.jsonstream import ItemStream
 from senaite.sync.syncerror import SyncError
+from senaite.sync.mappingstore import MAPPING
+from senaite.sync.mappingstore import MappingStorage
+from senaite.sync.pathtrie import PathTrie
 from senaite.sync.souphandler import REMOTE_PATH, LOCAL_PATH, PORTAL_TYPE
+from senaite.sync.uidlist import UIDList
 
 SYNC_STORAGE = "senaite.sync"
 API_BASE_URL = "@@API/senaite/v1"
@@ -26,6 +34,17 @@ API_BASE_URL = "@@API/senaite/v1"
 # response
 API_MAX_ATTEMPTS = 5
 API_ATTEMPT_INTERVAL = 5
+# Number of threads sending page requests to the source at once
+DEFAULT_FETCH_CONCURRENCY = 1
+# Maximum number of objects requested at once by their UIDs
+API_BATCH_SIZE = 50
+# Catalog index used to resume each page from the last item seen
+CURSOR_INDEX = "UID"
+# Size of the chunks JSON responses are decoded in while they arrive
+STREAM_CHUNK_SIZE = 64 * 1024
+# Parameters of the catalog listings, so the source returns the catalog
+# metadata only, without waking up the objects or listing their children
+LISTING_PARAMETERS = {"complete": False, "children": False}
 
 
 class SyncStep(object):
@@ -37,7 +56,11 @@ class SyncStep(object):
     def __init__(self, credentials, config):
         # Soup Handler to interact with the domain's soup table
         self.sh = None
+        # Remote paths with their local paths, see _get_path_trie
+        self._path_trie = None
         self.session = None
+        # Worker threads keep their own session here, see init_thread_session
+        self._local = threading.local()
         self.portal = api.get_portal()
 
         # Set Credentials
@@ -72,6 +95,12 @@ class SyncStep(object):
         # Types to contain Remote's Prefix in their ID's on this instance
         self.prefixable_types = config.get("prefixable_types", [])
 
+        # Number of page requests to keep in flight while fetching
+        self.fetch_concurrency = utils.to_int(
+            config.get("fetch_concurrency"), DEFAULT_FETCH_CONCURRENCY)
+        # Walk the catalog by UID instead of by b_start offsets
+        self.cursor_pagination = config.get("cursor_pagination", False)
+
     def translate_path(self, remote_path):
         """ Translates a remote physical path into local path taking into account
         the prefix. If prefix is not enabled, then just the Remote Site ID will
@@ -92,22 +121,26 @@ class SyncStep(object):
         if not self.remote_prefix and not self.local_prefix:
             return str(remote_path.replace(remote_portal_id, portal_id))
 
-        rec = self.sh.find_unique(REMOTE_PATH, remote_path)
-        if rec is None:
-            raise SyncError("error", "Missing Remote path in Soup table: {}"
-                            .format(remote_path))
+        node = self._get_path_trie().get(remote_path)
+        if node is None:
+            # The record might have been inserted after filling the trie
+            rec = self.sh.find_unique(REMOTE_PATH, remote_path)
+            if rec is None:
+                raise SyncError("error", "Missing Remote path in Soup table: {}"
+                                .format(remote_path))
+            node = self._path_trie.add(remote_path, rec[PORTAL_TYPE],
+                                       rec[LOCAL_PATH])
 
         # Check if previously translated and saved
-        if rec[LOCAL_PATH]:
-            return str(rec[LOCAL_PATH])
+        if node.local_path:
+            return str(node.local_path)
 
         # Get parent's local path
         remote_parent_path = utils.get_parent_path(remote_path)
         parent_path = self.translate_path(remote_parent_path)
 
         # Will check whether prefix needed by portal type
-        portal_type = rec[PORTAL_TYPE]
-        prefix = self.get_prefix(portal_type)
+        prefix = self.get_prefix(node.portal_type)
 
         # Remove Local Prefix
         rem_id = utils.get_id_from_path(remote_path)
@@ -116,9 +149,25 @@ class SyncStep(object):
         res = "{0}/{1}{2}".format(parent_path, prefix, local_id)
         res = res.replace(remote_portal_id, portal_id)
         # Save the local path in the Souper to use in the future
-        self.sh.update_by_remote_path(remote_path, LOCAL_PATH = res)
+        self.sh.update_by_remote_path(remote_path, **{LOCAL_PATH: res})
+        node.local_path = res
         return str(res)
 
+    def _get_path_trie(self):
+        """
+        Get the trie of remote paths used to translate them. It is filled
+        from the soup the first time it is needed.
+        :return: PathTrie
+        """
+        if self._path_trie is None:
+            self._path_trie = PathTrie()
+            for row in self.sh.get_records():
+                self._path_trie.add(row[REMOTE_PATH], row[PORTAL_TYPE],
+                                    row[LOCAL_PATH])
+            logger.info("Remote paths loaded: {}".format(
+                        len(self._path_trie)))
+        return self._path_trie
+
     def get_prefix(self, portal_type):
         """
         :param portal_type: content type to get the prefix for
@@ -157,13 +206,20 @@ class SyncStep(object):
 
         return False
 
-    def get_items(self, url_or_endpoint, **kw):
-        """Return the 'items' list from a std. JSON API response
+    def get_items(self, url_or_endpoint, transform=None, **kw):
+        """Yield the items of the 'items' list from a std. JSON API response.
+        Items are decoded one by one while the response arrives.
+        :param transform: function applied to each item as soon as it is
+                          decoded, e.g. to keep only part of it
         """
-        data = self.get_json(url_or_endpoint, **kw)
-        if not isinstance(data, dict):
-            return []
-        return data.get("items", [])
+        transform = transform or (lambda item: item)
+        stream = self.stream_json(url_or_endpoint, **kw)
+        try:
+            for item in stream:
+                yield transform(item)
+        except Exception as e:
+            logger.error("Could not decode the items of {}: {}".format(
+                url_or_endpoint, e))
 
     def get_items_with_retry(self, max_attempts=API_MAX_ATTEMPTS,
                              interval=API_ATTEMPT_INTERVAL, **kwargs):
@@ -172,27 +228,288 @@ class SyncStep(object):
         :param max_attempts: maximum number of attempts to try
         :param interval: time delay between attempts in seconds
         :param kwargs: query and parameters pass to get_items
-        :return:
+        :return: list of items
         """
         items = None
         for i in range(max_attempts):
-            items = self.get_items(**kwargs)
+            items = list(self.get_items(**kwargs))
             if items:
                 break
             sleep(interval)
         return items
 
     def yield_items(self, url_or_endpoint, **kw):
-        """Yield items of all pages
+        """Yield items of all pages, as soon as each of them is decoded
         """
-        data = self.get_json(url_or_endpoint, **kw)
-        for item in data.get("items", []):
-            yield item
-
-        next_url = data.get("next")
-        if next_url:
-            for item in self.yield_items(next_url, **kw):
+        while url_or_endpoint:
+            stream = self.stream_json(url_or_endpoint, **kw)
+            for item in stream:
                 yield item
+            url_or_endpoint = stream.data.get("next")
+
+    def get_page_with_retry(self, max_attempts=API_MAX_ATTEMPTS,
+                            interval=API_ATTEMPT_INTERVAL, **kwargs):
+        """
+        Retries to retrieve a page of items if HTTP response fails. Unlike
+        get_items_with_retry, an empty page is a valid response.
+        :param max_attempts: maximum number of attempts to try
+        :param interval: time delay between attempts in seconds
+        :param transform: function applied to each item as soon as it is
+                          decoded
+        :param kwargs: query and parameters pass to stream_json
+        :return: list of items or None if all the attempts failed
+        """
+        transform = kwargs.pop("transform", None) or (lambda item: item)
+        for i in range(max_attempts):
+            stream = self.stream_json(**kwargs)
+            try:
+                items = map(transform, stream)
+                if stream.found:
+                    return items
+            except Exception as e:
+                logger.error("Could not decode the items of {}: {}".format(
+                    kwargs.get("url_or_endpoint"), e))
+            sleep(interval)
+        return None
+
+    def yield_pages(self, query, count, window, overlap=0):
+        """Yield the items of a catalog query page by page. Pages are
+        requested from as many threads as the fetch concurrency, but yielded
+        in a deterministic order.
+        :param query: catalog query
+        :param count: overall number of items matching the query
+        :param window: number of items per page
+        :param overlap: overlap between pages, only used with offsets
+        :return: generator of item lists
+        """
+        pages = self.yield_checkpointed_pages(query, count, window, overlap)
+        try:
+            for items, checkpoint in pages:
+                yield items
+        finally:
+            pages.close()
+
+    def yield_checkpointed_pages(self, query, count, window, overlap=0,
+                                 checkpoint=None):
+        """Like yield_pages, but every page comes with a checkpoint: the
+        position reached once the page is handled. Passing a checkpoint
+        resumes the pagination right after the page it was yielded with.
+        :param checkpoint: checkpoint to resume from
+        :return: generator of (item list, checkpoint) tuples
+        """
+        if self.is_cursor_pagination(checkpoint):
+            return self._yield_cursor_pages(query, window, checkpoint)
+        return self._yield_offset_pages(query, count, window, overlap,
+                                        checkpoint)
+
+    def get_listing_query(self, query):
+        """Return the query with the listing parameters, so every request of
+        a catalog listing, including the one counting its items, gets the
+        same catalog metadata only projection from the source
+        """
+        return dict(query, **LISTING_PARAMETERS)
+
+    def is_cursor_pagination(self, checkpoint=None):
+        """Return whether pages are fetched by UID cursors. A fetch resumed
+        from a checkpoint goes on with the pagination it was started with
+        """
+        if checkpoint:
+            return checkpoint.get("pagination") == "cursor"
+        return self.cursor_pagination
+
+    def count_pages(self, count, window, overlap=0, cursor_pagination=None):
+        """Return the (estimated) number of pages yield_pages will return
+        :param cursor_pagination: whether pages are fetched by UID cursors.
+                                  The configured pagination if not given
+        """
+        if cursor_pagination is None:
+            cursor_pagination = self.cursor_pagination
+        if cursor_pagination:
+            return count / window + len(
+                utils.get_uid_ranges(self.fetch_concurrency))
+        return count / (window - overlap) + 1
+
+    def _yield_offset_pages(self, query, count, window, overlap,
+                            checkpoint=None):
+        """Yield the pages of a catalog query by b_start offsets. The
+        checkpoint is the number of pages already handled.
+        """
+        number_of_pages = self.count_pages(count, window, overlap,
+                                           cursor_pagination=False)
+        first_page = checkpoint.get("pages", 0) if checkpoint else 0
+
+        def fetch_page(page_number):
+            start_from = (page_number * window) - overlap
+            page_query = self.get_listing_query(
+                dict(query, limit=window, b_start=start_from))
+            items = self.get_items_with_retry(transform=utils.get_metadata,
+                                              **page_query)
+            if not items:
+                logger.error("CAN NOT GET ITEMS FROM {} TO {}".format(
+                    start_from, start_from + window))
+                return []
+            return items
+
+        pages = utils.ordered_parallel_map(
+            fetch_page, xrange(first_page, number_of_pages),
+            workers=self.fetch_concurrency,
+            initializer=self.init_thread_session)
+        try:
+            for page_number, items in enumerate(pages, first_page):
+                yield items, {"pagination": "offset", "pages": page_number + 1}
+        finally:
+            pages.close()
+
+    def _yield_cursor_pages(self, query, window, checkpoint=None):
+        """Yield the pages of a catalog query sorted by UID, where every page
+        starts from the last UID of the previous one. Thus, each page costs
+        the same no matter how deep it is and items added or removed in the
+        source during the fetch don't shift the following pages.
+        The UID space is split into ranges which are walked concurrently, and
+        the pages of the ranges are yielded in turns. The checkpoint keeps
+        the last UID handled of each range, or whether it is exhausted, and
+        the number of pages handled.
+        An empty page is yielded when a range is exhausted, so the checkpoint
+        reflects it. If the pages of a range can not be fetched, the error is
+        raised and the range is left as it was.
+        """
+        if checkpoint:
+            ranges = [list(uid_range) for uid_range in checkpoint["ranges"]]
+            page_number = checkpoint.get("pages", 0)
+        else:
+            ranges = [[lower, upper, lower, False] for lower, upper in
+                      utils.get_uid_ranges(self.fetch_concurrency)]
+            page_number = 0
+
+        def get_checkpoint(pages):
+            return {"pagination": "cursor", "pages": pages,
+                    "ranges": [tuple(uid_range) for uid_range in ranges]}
+
+        stop = threading.Event()
+        walks = []
+        for uid_range in ranges:
+            lower, upper, cursor, exhausted = uid_range
+            if exhausted:
+                continue
+            pages = Queue(maxsize=1)
+            thread = threading.Thread(
+                target=self._walk_uid_range,
+                args=(query, window, cursor, upper, pages, stop))
+            thread.daemon = True
+            thread.start()
+            walks.append((uid_range, thread, pages))
+
+        try:
+            active = list(walks)
+            while active:
+                for walk in list(active):
+                    uid_range, thread, pages = walk
+                    items = pages.get()
+                    if isinstance(items, Exception):
+                        # The range is not done, so the fetch must not go on
+                        # as if its remaining items did not exist
+                        raise items
+                    page_number += 1
+                    if items is None:
+                        active.remove(walk)
+                        uid_range[3] = True
+                        yield [], get_checkpoint(page_number)
+                        continue
+                    uid_range[2] = items[-1].get("uid")
+                    yield items, get_checkpoint(page_number)
+        finally:
+            stop.set()
+            for uid_range, thread, pages in walks:
+                thread.join()
+
+    def _walk_uid_range(self, query, window, lower, upper, pages, stop):
+        """Fetch the pages of a UID range one after the other and put them in
+        the given queue. Runs in a worker thread, so it must not access the
+        database. None is put in the queue when the range is exhausted, or
+        the error if its pages can not be fetched.
+        """
+        def put(items):
+            while not stop.is_set():
+                try:
+                    pages.put(items, timeout=1)
+                    return
+                except Full:
+                    continue
+
+        self.init_thread_session()
+        cursor = lower
+        try:
+            while not stop.is_set():
+                page_query = dict(query, limit=window, sort_on=CURSOR_INDEX,
+                                  sort_order="ascending")
+                page_query.update(self._get_uid_range_query(cursor, upper))
+                page_query = self.get_listing_query(page_query)
+                items = self.get_page_with_retry(transform=utils.get_metadata,
+                                                 **page_query)
+                if items is None:
+                    message = "CAN NOT GET ITEMS AFTER UID {}".format(cursor)
+                    logger.error(message)
+                    put(SyncError("error", message))
+                    return
+                # Range bounds are inclusive
+                page = filter(lambda item: item.get("uid") != cursor and (
+                    not upper or item.get("uid") < upper), items)
+                if page:
+                    put(page)
+                if len(items) < window:
+                    break
+                cursor = items[-1].get("uid")
+        except Exception as e:
+            logger.error("Walk of the UIDs after {} failed: {}".format(
+                cursor, e))
+            put(e)
+            return
+        put(None)
+
+    def _get_uid_range_query(self, lower, upper):
+        """Return the request parameters to restrict a catalog query to an
+        (inclusive) range of UIDs
+        """
+        if lower and upper:
+            bounds, range_usage = [lower, upper], "min:max"
+        elif lower:
+            bounds, range_usage = [lower], "min"
+        elif upper:
+            bounds, range_usage = [upper], "max"
+        else:
+            return {}
+        return {
+            "{}.query:record:list".format(CURSOR_INDEX): bounds,
+            "{}.range:record".format(CURSOR_INDEX): range_usage,
+        }
+
+    def get_objects_data(self, uids):
+        """Fetch the complete data, including the workflow information, of
+        the objects with the given UIDs. Objects are requested in batches
+        through the search endpoint and the ones missing in the responses
+        are requested one by one.
+        :param uids: remote UIDs of the objects
+        :return: dictionary of {uid: data}
+        """
+        uids = list(uids)
+        objects_data = {}
+        for batch in utils.chunks(uids, API_BATCH_SIZE):
+            items = self.get_items("search", catalog="uid_catalog", UID=batch,
+                                   complete=True, workflow=True,
+                                   limit=len(batch))
+            for item in items:
+                uid = item.get("uid")
+                if uid in batch:
+                    objects_data[uid] = item
+
+        for uid in uids:
+            if uid in objects_data:
+                continue
+            logger.debug("Fetching the data of {} separately".format(uid))
+            item = self.get_json(uid, complete=True, workflow=True)
+            if item:
+                objects_data[uid] = item
+        return objects_data
 
     def get_first_item(self, url_or_endpoint, **kw):
         """Fetch the first item of the 'items' list from a std. JSON API reponse
@@ -207,8 +524,9 @@ class SyncStep(object):
         """
         api_url = self.get_api_url(url_or_endpoint, **kw)
         logger.debug("get_json::url={}".format(api_url))
+        session = getattr(self._local, "session", None) or self.session
         try:
-            response = self.session.get(api_url)
+            response = session.get(api_url)
         except Exception as e:
             message = "Could not connect to {} Please check.".format(
                 api_url)
@@ -223,6 +541,32 @@ class SyncStep(object):
             return {}
         return response.json()
 
+    def stream_json(self, url_or_endpoint, **kw):
+        """Fetch the given url or endpoint and return an ItemStream, which
+        yields the 'items' of the JSON response while they arrive. The stream
+        is empty if the request fails.
+        """
+        api_url = self.get_api_url(url_or_endpoint, **kw)
+        logger.debug("stream_json::url={}".format(api_url))
+        session = getattr(self._local, "session", None) or self.session
+        try:
+            response = session.get(api_url, stream=True)
+        except Exception as e:
+            message = "Could not connect to {} Please check.".format(
+                api_url)
+            logger.error(message)
+            logger.error(e)
+            return ItemStream([])
+        status = response.status_code
+        if status != 200:
+            message = "GET for {} ({}) returned Status Code {}. Please check.".format(
+                url_or_endpoint, api_url, status)
+            logger.error(message)
+            response.close()
+            return ItemStream([])
+        return ItemStream(response.iter_content(STREAM_CHUNK_SIZE),
+                          close=response.close)
+
     def get_api_url(self, url_or_endpoint, **kw):
         """Create an API URL from an endpoint or absolute url
         """
@@ -240,7 +584,7 @@ class SyncStep(object):
             if query:
                 query = dict(urlparse.parse_qsl(query))
                 kw.update(query)
-            q = urllib.urlencode(kw)
+            q = urllib.urlencode(kw, doseq=True)
             return "{}://{}{}?{}".format(scheme, netloc, path, q)
         return url_or_endpoint
 
@@ -255,6 +599,12 @@ class SyncStep(object):
         session.auth = (self.username, self.password)
         return session
 
+    def init_thread_session(self):
+        """Give the current (worker) thread its own session, since sessions
+        must not be shared amongst threads
+        """
+        self._local.session = self.get_session()
+
     def fail(self, message, status):
         """Raise a SyncError
         """
@@ -276,7 +626,8 @@ class SyncStep(object):
             self.storage[domain]["credentials"] = OOBTree()
             self.storage[domain]["registry"] = OOBTree()
             self.storage[domain]["settings"] = OOBTree()
-            self.storage[domain]["ordered_uids"] = []
+            self.storage[domain]["ordered_uids"] = UIDList()
+            self.storage[domain][MAPPING] = MappingStorage()
             self.storage[domain]["configuration"] = OOBTree()
             self.storage[domain]["last_fetch_time"] = DateTime()
         return self.storage[domain]
@@ -316,7 +667,8 @@ class SyncStep(object):
         if self.sh.find_unique(REMOTE_PATH, parent_path):
             return True
         logger.debug("Inserting missing parent: {}".format(parent_path))
-        parent = self.get_first_item(item.get("parent_url"))
+        parent = self.get_first_item(item.get("parent_url"),
+                                     **LISTING_PARAMETERS)
         if not parent:
             logger.error("Cannot fetch parent info: {} ".format(parent_path))
             return False
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SYNC
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+import unittest
+
+from senaite.sync.dependencygraph import DependencyGraph
+
+
+def make_graph(*edges):
+    """ Build a graph from (node, dependency) tuples
+    """
+    graph = DependencyGraph()
+    for node, dependency in edges:
+        graph.add_dependency(node, dependency)
+    return graph
+
+
+class TestDependencyGraph(unittest.TestCase):
+
+    def assertBefore(self, order, first, second):
+        """ Check the component of 'first' comes before the one of 'second'
+        """
+        positions = dict((node, pos) for pos, component in enumerate(order)
+                         for node in component)
+        self.assertLess(positions[first], positions[second])
+
+    def test_nodes(self):
+        graph = make_graph(("a", "b"), ("a", "b"), ("a", "c"))
+        graph.add_node("d")
+        graph.add_node("a")
+        self.assertEqual(list(graph), ["a", "b", "c", "d"])
+        self.assertEqual(len(graph), 4)
+        self.assertIn("d", graph)
+        self.assertNotIn("e", graph)
+        self.assertEqual(graph.get_dependencies("a"), ["b", "c"])
+        self.assertEqual(graph.get_dependencies("b"), [])
+        self.assertEqual(graph.get_dependencies("e"), [])
+
+    def test_empty_graph(self):
+        self.assertEqual(DependencyGraph().get_import_order(), [])
+
+    def test_dependencies_come_first(self):
+        graph = make_graph(("a", "b"), ("b", "c"), ("d", "c"), ("a", "d"))
+        order = graph.get_import_order()
+        self.assertEqual(order, [["c"], ["b"], ["d"], ["a"]])
+
+    def test_independent_nodes_keep_their_order(self):
+        graph = DependencyGraph()
+        for node in ("c", "a", "b"):
+            graph.add_node(node)
+        self.assertEqual(graph.get_import_order(), [["c"], ["a"], ["b"]])
+
+    def test_cycle(self):
+        graph = make_graph(("a", "b"), ("b", "c"), ("c", "a"), ("d", "a"),
+                           ("c", "e"))
+        order = graph.get_import_order()
+        self.assertEqual(len(order), 3)
+        self.assertEqual(sorted(order[1]), ["a", "b", "c"])
+        self.assertBefore(order, "e", "a")
+        self.assertBefore(order, "a", "d")
+
+    def test_self_dependency(self):
+        graph = make_graph(("a", "a"), ("b", "a"))
+        self.assertEqual(graph.get_import_order(), [["a"], ["b"]])
+
+    def test_several_cycles(self):
+        graph = make_graph(("a", "b"), ("b", "a"), ("b", "c"), ("c", "d"),
+                           ("d", "c"))
+        order = graph.get_import_order()
+        self.assertEqual(map(sorted, order), [["c", "d"], ["a", "b"]])
+
+    def test_every_node_once(self):
+        edges = [(str(i), str((i * 7) % 50)) for i in range(50)]
+        edges += [(str(i), str(i + 1)) for i in range(49)]
+        graph = make_graph(*edges)
+        order = graph.get_import_order()
+        nodes = [node for component in order for node in component]
+        self.assertEqual(sorted(nodes), sorted(graph))
+        for node, dependency in edges:
+            if not any(node in c and dependency in c for c in order):
+                self.assertBefore(order, dependency, node)
+
+    def test_deep_chain(self):
+        # The graph is walked without recursion
+        edges = [(i, i + 1) for i in range(5000)]
+        order = make_graph(*edges).get_import_order()
+        self.assertEqual(order, [[i] for i in range(5000, -1, -1)])
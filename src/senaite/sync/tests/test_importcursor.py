@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SYNC
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+import unittest
+
+from senaite.sync.importcursor import ImportCursor
+from senaite.sync.uidlist import UIDList
+
+UIDS = ["uid-{}".format(i) for i in range(10)]
+
+
+class TestImportCursor(unittest.TestCase):
+
+    def test_new_cursor(self):
+        cursor = ImportCursor()
+        self.assertEqual(cursor.position, 0)
+        self.assertEqual(list(cursor.failed), [])
+
+    def test_resume_position(self):
+        # Fetched UIDs are imported from the end of the list, so the
+        # position is the number of UIDs to be skipped there
+        uids = UIDList(UIDS)
+        cursor = ImportCursor()
+        handled = list(uids.iter_reversed(skip=cursor.position))[:4]
+        cursor.position += len(handled)
+        remaining = list(uids.iter_reversed(skip=cursor.position))
+        self.assertEqual(handled, ["uid-9", "uid-8", "uid-7", "uid-6"])
+        self.assertEqual(remaining, UIDS[5::-1])
+
+        cursor.position = len(uids)
+        self.assertEqual(list(uids.iter_reversed(skip=cursor.position)), [])
+
+    def test_failed(self):
+        cursor = ImportCursor()
+        cursor.add_failed("uid-2")
+        cursor.add_failed("uid-1")
+        cursor.add_failed("uid-2")
+        self.assertEqual(list(cursor.failed), ["uid-1", "uid-2"])
+        cursor.remove_failed("uid-2")
+        cursor.remove_failed("uid-3")
+        self.assertEqual(list(cursor.failed), ["uid-1"])
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SYNC
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+import json
+import unittest
+
+from senaite.sync.jsonstream import ItemStream
+
+DOCUMENT = {
+    "count": 4,
+    "items": [
+        {"uid": "a1", "size": 7.5, "ratio": -2, "exp": 1e3},
+        {"uid": u"b\xe9", "flags": [True, False, None], "nested": {"x": []}},
+        -12.25e-3,
+        "text, with ] and } inside",
+    ],
+    "next": None,
+    "total": 1234567,
+}
+
+
+def split_at(text, *offsets):
+    """ Split the text into chunks at the given offsets
+    """
+    bounds = [0] + list(offsets) + [len(text)]
+    return [text[start:end] for start, end in zip(bounds, bounds[1:])]
+
+
+class TestItemStream(unittest.TestCase):
+
+    def assertDecoded(self, chunks, expected):
+        stream = ItemStream(chunks)
+        self.assertEqual(list(stream), expected["items"])
+        self.assertTrue(stream.found)
+        data = dict(expected)
+        del data["items"]
+        self.assertEqual(stream.data, data)
+
+    def test_single_chunk(self):
+        text = json.dumps(DOCUMENT)
+        self.assertDecoded([text], DOCUMENT)
+
+    def test_split_at_every_offset(self):
+        text = json.dumps(DOCUMENT, ensure_ascii=False).encode("utf-8")
+        for offset in range(1, len(text)):
+            self.assertDecoded(split_at(text, offset), DOCUMENT)
+
+    def test_one_byte_chunks(self):
+        text = json.dumps(DOCUMENT, ensure_ascii=False).encode("utf-8")
+        self.assertDecoded(list(text), DOCUMENT)
+
+    def test_split_numbers(self):
+        for number in ("7.5", "1e3", "-2", "12.25e-3", "1E+10", "100"):
+            text = '{"items": [%s, %s]}' % (number, number)
+            expected = json.loads(text)
+            for offset in range(1, len(text)):
+                self.assertEqual(list(ItemStream(split_at(text, offset))),
+                                 expected["items"])
+
+    def test_split_literals(self):
+        text = '{"items": [true, false, null]}'
+        for offset in range(1, len(text)):
+            self.assertEqual(list(ItemStream(split_at(text, offset))),
+                             [True, False, None])
+
+    def test_number_at_the_end(self):
+        stream = ItemStream(['{"items": [], "count": 1', '2}'])
+        list(stream)
+        self.assertEqual(stream.data, {"count": 12})
+
+    def test_empty_stream(self):
+        stream = ItemStream([])
+        self.assertEqual(list(stream), [])
+        self.assertFalse(stream.found)
+
+    def test_missing_list(self):
+        stream = ItemStream(['{"count": 0}'])
+        self.assertEqual(list(stream), [])
+        self.assertFalse(stream.found)
+        self.assertEqual(stream.data, {"count": 0})
+
+    def test_other_key(self):
+        stream = ItemStream(['{"items": [1], "objects": [2, 3]}'],
+                            key="objects")
+        self.assertEqual(list(stream), [2, 3])
+        self.assertEqual(stream.data, {"items": [1]})
+
+    def test_truncated_document(self):
+        stream = ItemStream(['{"items": [1, 2'])
+        self.assertRaises(ValueError, list, stream)
+
+    def test_close(self):
+        closed = []
+        stream = ItemStream(['{"items": [1]}'],
+                            close=lambda: closed.append(True))
+        list(stream)
+        self.assertEqual(closed, [True])
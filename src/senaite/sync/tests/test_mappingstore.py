@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SYNC
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+import unittest
+
+from senaite.sync import mappingstore
+from senaite.sync.mappingstore import MappingHandler
+from senaite.sync.mappingstore import MappingStorage
+from senaite.sync.mappingstore import to_values
+from senaite.sync.souphandler import GENERATION
+from senaite.sync.souphandler import LOCAL_PATH
+from senaite.sync.souphandler import LOCAL_UID
+from senaite.sync.souphandler import PORTAL_TYPE
+from senaite.sync.souphandler import REC_ID
+from senaite.sync.souphandler import REMOTE_PATH
+from senaite.sync.souphandler import REMOTE_UID
+from senaite.sync.souphandler import Row
+from senaite.sync.souphandler import UPDATED
+from senaite.sync.souphandler import get_generation
+
+
+def make_row(number, **kwargs):
+    """ Build the row dictionary of a remote object
+    """
+    row = {
+        REMOTE_UID: "r-uid-{}".format(number),
+        REMOTE_PATH: "/remote/client-{}".format(number),
+        PORTAL_TYPE: "Client",
+    }
+    row.update(kwargs)
+    return row
+
+
+def make_handler(mapping=None):
+    """ Build a handler of the mapping table without a portal
+    """
+    handler = MappingHandler.__new__(MappingHandler)
+    handler.domain_name = "domain"
+    handler.portal = None
+    handler.mapping = MappingStorage() if mapping is None else mapping
+    handler._generation = 1
+    return handler
+
+
+class TestMappingStorage(unittest.TestCase):
+
+    def test_add(self):
+        storage = MappingStorage()
+        values = to_values(make_row(1))
+        self.assertEqual(storage.add(values), 1)
+        self.assertEqual(storage.add(to_values(make_row(2))), 2)
+        self.assertEqual(storage.add(to_values(make_row(3)), rec_id=10), 10)
+        self.assertEqual(storage.add(to_values(make_row(4))), 11)
+        self.assertEqual(len(storage), 4)
+        self.assertEqual(storage.get(1), values)
+        self.assertIsNone(storage.get(5))
+
+    def test_unique_indexes(self):
+        storage = MappingStorage()
+        rec_id = storage.add(to_values(make_row(1)))
+        self.assertEqual(storage.get_id(REMOTE_UID, "r-uid-1"), rec_id)
+        self.assertEqual(storage.get_id(REMOTE_PATH, "/remote/client-1"),
+                         rec_id)
+        # Empty values are not indexed
+        self.assertIsNone(storage.get_id(LOCAL_UID, ""))
+        self.assertIsNone(storage.get_id(REMOTE_UID, "r-uid-2"))
+
+    def test_add_many(self):
+        storage = MappingStorage()
+        storage.add(to_values(make_row(0)))
+        rec_ids = storage.add_many([to_values(make_row(i))
+                                    for i in range(1, 4)])
+        self.assertEqual(rec_ids, [2, 3, 4])
+        self.assertEqual(len(storage), 4)
+        self.assertEqual(storage.get_id(REMOTE_UID, "r-uid-3"), 4)
+        self.assertEqual(storage.add_many([]), [])
+        self.assertEqual(len(storage), 4)
+
+    def test_set(self):
+        storage = MappingStorage()
+        rec_id = storage.add(to_values(make_row(1)))
+        row = Row(rec_id, storage.get(rec_id)).replace(
+            **{LOCAL_UID: "l-uid-1", REMOTE_PATH: "/remote/moved-1"})
+        storage.set(rec_id, row.column_values)
+        self.assertEqual(storage.get_id(LOCAL_UID, "l-uid-1"), rec_id)
+        self.assertEqual(storage.get_id(REMOTE_PATH, "/remote/moved-1"),
+                         rec_id)
+        self.assertIsNone(storage.get_id(REMOTE_PATH, "/remote/client-1"))
+        self.assertEqual(storage.get_id(REMOTE_UID, "r-uid-1"), rec_id)
+        self.assertEqual(len(storage), 1)
+
+
+class TestMappingHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = make_handler()
+
+    def test_insert(self):
+        rec_id = self.handler.insert(make_row(1))
+        self.assertTrue(rec_id)
+        self.assertFalse(self.handler.insert(make_row(1)))
+        # Any unique column identifies the record
+        self.assertFalse(self.handler.insert(
+            make_row(2, **{REMOTE_PATH: "/remote/client-1"})))
+        row = self.handler.find_unique(REMOTE_UID, "r-uid-1")
+        self.assertEqual(row[REC_ID], rec_id)
+        self.assertEqual(row[REMOTE_PATH], "/remote/client-1")
+        self.assertIsNone(self.handler.find_unique(REMOTE_UID, "r-uid-2"))
+
+    def test_bulk_insert(self):
+        self.handler.insert(make_row(1))
+        rows = [
+            make_row(2),
+            # exists in the table
+            make_row(1),
+            make_row(3),
+            # exists earlier in the batch
+            make_row(4, **{REMOTE_PATH: "/remote/client-2"}),
+            make_row(3),
+            make_row(5),
+        ]
+        rec_ids = self.handler.bulk_insert(rows)
+        self.assertEqual(rec_ids, [2, False, 3, False, False, 4])
+        self.assertEqual(len(self.handler.mapping), 4)
+        self.assertIsNone(self.handler.find_unique(REMOTE_UID, "r-uid-4"))
+        self.assertEqual(
+            self.handler.find_unique(REMOTE_PATH, "/remote/client-2")[
+                REMOTE_UID], "r-uid-2")
+
+    def test_update(self):
+        self.handler.insert(make_row(1))
+        self.assertTrue(self.handler.update_by_remote_uid(
+            "r-uid-1", **{LOCAL_UID: "l-uid-1"}))
+        self.assertTrue(self.handler.update_by_remote_path(
+            "/remote/client-1", **{LOCAL_PATH: "/local/client-1"}))
+        self.assertFalse(self.handler.update_by_remote_uid(
+            "r-uid-2", **{LOCAL_UID: "l-uid-2"}))
+        self.assertEqual(self.handler.get_local_uid("r-uid-1"), "l-uid-1")
+        self.assertIsNone(self.handler.get_local_uid("r-uid-2"))
+        row = self.handler.find_unique(LOCAL_PATH, "/local/client-1")
+        self.assertEqual(row[REMOTE_UID], "r-uid-1")
+        self.assertEqual([r[REMOTE_UID] for r in self.handler.get_records()],
+                         ["r-uid-1"])
+
+
+class TestGeneration(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = dict()
+        self._get_domain_storage = mappingstore.get_domain_storage
+        mappingstore.get_domain_storage = lambda portal, name: self.storage
+        self.handler = make_handler()
+        self.handler._generation = get_generation(self.storage)
+
+    def tearDown(self):
+        mappingstore.get_domain_storage = self._get_domain_storage
+
+    def test_get_generation(self):
+        self.assertEqual(get_generation(None), 1)
+        self.assertEqual(get_generation({}), 1)
+        self.assertEqual(get_generation({GENERATION: 5}), 5)
+
+    def test_is_updated(self):
+        self.handler.bulk_insert([make_row(1), make_row(2)])
+        self.assertTrue(self.handler.mark_update(
+            "r-uid-1", **{LOCAL_UID: "l-uid-1"}))
+        updated = self.handler.find_unique(REMOTE_UID, "r-uid-1")
+        self.assertEqual(updated[UPDATED], "1")
+        self.assertEqual(updated[LOCAL_UID], "l-uid-1")
+        self.assertTrue(self.handler.is_updated(updated))
+        self.assertFalse(self.handler.is_updated(
+            self.handler.find_unique(REMOTE_UID, "r-uid-2")))
+        self.assertFalse(self.handler.is_updated({}))
+
+    def test_reset_updated_flags(self):
+        self.handler.insert(make_row(1))
+        self.handler.mark_update("r-uid-1")
+        self.assertTrue(self.handler.reset_updated_flags())
+        self.assertEqual(self.storage[GENERATION], 2)
+        # No record is written, the old generation is just not current
+        row = self.handler.find_unique(REMOTE_UID, "r-uid-1")
+        self.assertEqual(row[UPDATED], "1")
+        self.assertFalse(self.handler.is_updated(row))
+
+        self.handler.mark_update("r-uid-1")
+        row = self.handler.find_unique(REMOTE_UID, "r-uid-1")
+        self.assertTrue(self.handler.is_updated(row))
+
+        # Handlers created later continue with the stored generation
+        handler = make_handler(self.handler.mapping)
+        handler._generation = get_generation(self.storage)
+        self.assertTrue(handler.is_updated(row))
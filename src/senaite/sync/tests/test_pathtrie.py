@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SYNC
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+import unittest
+
+from senaite.sync.pathtrie import PathTrie
+from senaite.sync.pathtrie import split_path
+
+
+class TestPathTrie(unittest.TestCase):
+
+    def test_split_path(self):
+        self.assertEqual(split_path("/senaite/clients/client-1"),
+                         ["senaite", "clients", "client-1"])
+        self.assertEqual(split_path("senaite//clients/"),
+                         ["senaite", "clients"])
+        self.assertEqual(split_path("/"), [])
+
+    def test_add_and_get(self):
+        trie = PathTrie()
+        node = trie.add("/senaite/clients/client-1", portal_type="Client",
+                        local_path="/local/clients/client-1")
+        self.assertIs(trie.get("/senaite/clients/client-1"), node)
+        self.assertEqual(node.portal_type, "Client")
+        self.assertEqual(node.local_path, "/local/clients/client-1")
+        self.assertIn("/senaite/clients/client-1/", trie)
+        self.assertEqual(len(trie), 1)
+
+    def test_ancestors_are_not_known(self):
+        trie = PathTrie()
+        trie.add("/senaite/clients/client-1")
+        self.assertIsNone(trie.get("/senaite/clients"))
+        self.assertNotIn("/senaite", trie)
+        self.assertNotIn("/senaite/clients/client-2", trie)
+        self.assertNotIn("/senaite/clients/client-1/sample-1", trie)
+
+        trie.add("/senaite/clients", portal_type="ClientFolder")
+        self.assertEqual(trie.get("/senaite/clients").portal_type,
+                         "ClientFolder")
+        self.assertEqual(len(trie), 2)
+
+    def test_update(self):
+        trie = PathTrie()
+        trie.add("/senaite/clients/client-1", portal_type="Client")
+        node = trie.add("/senaite/clients/client-1",
+                        local_path="/local/clients/client-1")
+        # Missing values do not clear the known ones
+        trie.add("/senaite/clients/client-1")
+        self.assertEqual(node.portal_type, "Client")
+        self.assertEqual(node.local_path, "/local/clients/client-1")
+        self.assertEqual(len(trie), 1)
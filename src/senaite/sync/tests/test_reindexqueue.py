@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SYNC
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+import unittest
+
+from senaite.sync import reindexqueue
+from senaite.sync.reindexqueue import COMPUTED_INDEXES
+from senaite.sync.reindexqueue import ReindexQueue
+
+
+class Index(object):
+
+    def __init__(self, name, sources=None):
+        self.name = name
+        self.sources = sources or [name]
+
+    def getId(self):
+        return self.name
+
+    def getIndexSourceNames(self):
+        return self.sources
+
+
+class Catalog(object):
+
+    def __init__(self, *indexes):
+        self._indexes = indexes
+
+    def indexes(self):
+        return [index.getId() for index in self._indexes]
+
+    def getIndexObjects(self):
+        return list(self._indexes)
+
+
+class Field(object):
+
+    def __init__(self, accessor):
+        self.accessor = accessor
+
+
+class Content(object):
+    """ An object recording the indexes it was reindexed with
+    """
+
+    def __init__(self):
+        self.reindexed = []
+
+    def reindexObject(self, idxs=None):
+        self.reindexed.append(idxs)
+
+
+class API(object):
+    """ Provides the functions of senaite.api the queue uses
+    """
+
+    def __init__(self, objects, catalog):
+        self.objects = objects
+        self.catalog = catalog
+
+    def get_object_by_uid(self, uid):
+        return self.objects[uid]
+
+    def get_portal_type(self, obj):
+        return "Client"
+
+    def get_fields(self, obj):
+        return {"title": Field("Title")}
+
+    def get_catalogs_for(self, obj):
+        return [self.catalog]
+
+
+class TestReindexQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.objects = dict((uid, Content()) for uid in ("a", "b", "c"))
+        catalog = Catalog(Index("Title"), Index("getClientTitle"),
+                          Index("sortable_title", ["title"]))
+        self._api = reindexqueue.api
+        reindexqueue.api = API(self.objects, catalog)
+
+    def tearDown(self):
+        reindexqueue.api = self._api
+
+    def test_deduplication(self):
+        queue = ReindexQueue()
+        queue.add("a")
+        queue.add("b", idxs=["Title"])
+        queue.add("a")
+        queue.add("b", idxs=["getClientTitle"])
+        queue.add(None)
+        queue.add("")
+        self.assertEqual(len(queue), 2)
+        self.assertIn("a", queue)
+        self.assertNotIn("c", queue)
+        self.assertEqual(queue.requested, 4)
+        self.assertEqual(queue.saved, 2)
+
+    def test_flush(self):
+        queue = ReindexQueue()
+        queue.add("a")
+        queue.add("a", idxs=["Title"])
+        queue.add("b", idxs=["Title"])
+        queue.add("b", idxs=["getClientTitle"])
+        self.assertEqual(queue.flush(), 2)
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(self.objects["a"].reindexed, [None])
+        self.assertEqual(self.objects["b"].reindexed,
+                         [["Title", "getClientTitle"]])
+        self.assertEqual(queue.reindexed, 2)
+        self.assertEqual(queue.saved, 2)
+
+        queue.add("a")
+        self.assertEqual(queue.saved, 2)
+        queue.flush()
+        self.assertEqual(self.objects["a"].reindexed, [None, None])
+        self.assertEqual(queue.saved, 2)
+
+    def test_keep_modified(self):
+        queue = ReindexQueue()
+        queue.add("a", keep_modified=True)
+        queue.add("b", idxs=["Title"], keep_modified=True)
+        queue.flush()
+        # All the indexes are given, so the modification date is kept
+        self.assertEqual(self.objects["a"].reindexed,
+                         [["Title", "getClientTitle", "sortable_title"]])
+        self.assertEqual(self.objects["b"].reindexed, [["Title"]])
+
+    def test_computed_indexes(self):
+        queue = ReindexQueue()
+        queue.add("a", idxs=[COMPUTED_INDEXES])
+        queue.add("b", idxs=[COMPUTED_INDEXES, "Title"])
+        queue.add("c", idxs=[COMPUTED_INDEXES])
+        queue.add("c")
+        queue.flush()
+        self.assertEqual(self.objects["a"].reindexed, [["getClientTitle"]])
+        self.assertEqual(self.objects["b"].reindexed,
+                         [["Title", "getClientTitle"]])
+        self.assertEqual(self.objects["c"].reindexed, [None])
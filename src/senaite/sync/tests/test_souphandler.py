@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SYNC
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+import pickle
+import unittest
+
+from senaite.sync.souphandler import COLUMNS
+from senaite.sync.souphandler import DEFAULTS
+from senaite.sync.souphandler import LOCAL_UID
+from senaite.sync.souphandler import PORTAL_TYPE
+from senaite.sync.souphandler import REC_ID
+from senaite.sync.souphandler import REMOTE_MODIFIED
+from senaite.sync.souphandler import REMOTE_UID
+from senaite.sync.souphandler import Row
+from senaite.sync.souphandler import UPDATED
+
+VALUES = ("r-uid", "l-uid", "/remote/client-1", "/local/client-1", "Client",
+          "3", "2018-01-01")
+
+
+class TestRow(unittest.TestCase):
+
+    def test_columns(self):
+        row = Row(7, VALUES)
+        self.assertEqual(row[REC_ID], 7)
+        self.assertEqual(row[REMOTE_UID], "r-uid")
+        self.assertEqual(row[0], 7)
+        self.assertEqual(row.get(PORTAL_TYPE), "Client")
+        self.assertEqual(row.get("unknown", "default"), "default")
+        self.assertRaises(KeyError, row.__getitem__, "unknown")
+        self.assertIn(LOCAL_UID, row)
+        self.assertNotIn("unknown", row)
+        self.assertEqual(row.column_values, VALUES)
+        self.assertEqual(row.keys(), [REC_ID] + list(COLUMNS))
+        self.assertEqual(row.as_dict(), dict(zip(row.keys(), (7, ) + VALUES)))
+
+    def test_missing_columns(self):
+        # Records stored before a column was added get its default value
+        row = Row(1, VALUES[:5])
+        self.assertEqual(row[UPDATED], DEFAULTS[COLUMNS.index(UPDATED)])
+        self.assertEqual(row[REMOTE_MODIFIED], "")
+        self.assertEqual(len(row.column_values), len(COLUMNS))
+
+    def test_replace(self):
+        row = Row(7, VALUES)
+        new_row = row.replace(**{UPDATED: "4", LOCAL_UID: "other"})
+        self.assertIsInstance(new_row, Row)
+        self.assertEqual(new_row[REC_ID], 7)
+        self.assertEqual(new_row[UPDATED], "4")
+        self.assertEqual(new_row[LOCAL_UID], "other")
+        self.assertEqual(new_row[REMOTE_UID], "r-uid")
+        # Rows are immutable
+        self.assertEqual(row[UPDATED], "3")
+        with self.assertRaises(TypeError):
+            row[UPDATED] = "5"
+        self.assertRaises(AttributeError, setattr, row, "extra", 1)
+
+    def test_pickle(self):
+        row = Row(7, VALUES)
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            copy = pickle.loads(pickle.dumps(row, protocol))
+            self.assertIsInstance(copy, Row)
+            self.assertEqual(copy, row)
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SYNC
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+import unittest
+
+from senaite.sync.uidlist import UIDList
+
+UIDS = ["uid-{}".format(i) for i in range(10)]
+
+
+class TestUIDList(unittest.TestCase):
+
+    def test_empty(self):
+        uids = UIDList()
+        self.assertEqual(len(uids), 0)
+        self.assertEqual(list(uids), [])
+        self.assertEqual(list(reversed(uids)), [])
+        self.assertRaises(IndexError, uids.__getitem__, 0)
+
+    def test_append(self):
+        uids = UIDList(UIDS[:5])
+        for uid in UIDS[5:]:
+            uids.append(uid)
+        self.assertEqual(len(uids), 10)
+        self.assertEqual(list(uids), UIDS)
+
+    def test_getitem(self):
+        uids = UIDList(UIDS)
+        self.assertEqual(uids[0], "uid-0")
+        self.assertEqual(uids[9], "uid-9")
+        self.assertEqual(uids[-1], "uid-9")
+        self.assertEqual(uids[-10], "uid-0")
+        self.assertRaises(IndexError, uids.__getitem__, 10)
+        self.assertRaises(IndexError, uids.__getitem__, -11)
+
+    def test_reversed(self):
+        uids = UIDList(UIDS)
+        self.assertEqual(list(reversed(uids)), UIDS[::-1])
+        self.assertEqual(list(uids.iter_reversed(skip=3)), UIDS[6::-1])
+        self.assertEqual(list(uids.iter_reversed(skip=10)), [])
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SYNC
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+from BTrees.IOBTree import IOBTree
+from BTrees.Length import Length
+from persistent import Persistent
+
+
+class UIDList(Persistent):
+    """
+    An append-only list of UIDs to be stored in the ZODB. Items are kept in
+    an IOBTree keyed by their position, so appending an item is cheap and a
+    commit only writes the buckets that changed instead of the whole list.
+    """
+
+    def __init__(self, uids=None):
+        self._data = IOBTree()
+        self._length = Length()
+        for uid in uids or []:
+            self.append(uid)
+
+    def append(self, uid):
+        """
+        Adds the UID to the end of the list.
+        :param uid: UID to be added
+        """
+        self._data[len(self)] = uid
+        self._length.change(1)
+
+    def __len__(self):
+        return self._length()
+
+    def __getitem__(self, position):
+        if position < 0:
+            position += len(self)
+        try:
+            return self._data[position]
+        except KeyError:
+            raise IndexError("UIDList index out of range")
+
+    def __iter__(self):
+        return iter(self._data.values())
+
+    def __reversed__(self):
+        return self.iter_reversed()
+
+    def iter_reversed(self, skip=0):
+        """
+        Iterates over the list from the end.
+        :param skip: number of items to be skipped at the end of the list
+        """
+        for position in xrange(len(self) - 1 - skip, -1, -1):
+            yield self._data[position]
@@ -12,10 +12,16 @@ from DateTime import DateTime
 
 from senaite import api
 from senaite.sync.importstep import ImportStep
+from senaite.sync.reindexqueue import ReindexQueue
 
 from senaite.sync import logger, utils
-from senaite.sync.souphandler import SoupHandler, REMOTE_UID, LOCAL_UID, \
-                                     REMOTE_PATH, LOCAL_PATH
+from senaite.sync.mappingstore import get_mapping_handler
+from senaite.sync.souphandler import REMOTE_UID, REMOTE_PATH, LOCAL_PATH, \
+                                     REMOTE_MODIFIED, REC_ID
+
+# Seconds the objects are fetched from before the last fetch time, so objects
+# modified while it ran or clock differences don't make any object be missed
+FETCH_TIME_MARGIN = 10 * 60
 
 
 class UpdateStep(ImportStep):
@@ -27,8 +33,6 @@ class UpdateStep(ImportStep):
     def __init__(self, credentials, config, fetch_time):
         ImportStep.__init__(self, credentials, config)
         self.fetch_time = fetch_time
-        # Keep modification times in a dictionary to restore after Update Step
-        self.modification_dates = dict()
 
     def run(self):
         """
@@ -38,8 +42,10 @@ class UpdateStep(ImportStep):
         self._fetch_data()
         transaction.commit()
         self._create_new_objects()
-        self._update_objects()
-        self.restore_modification_dates()
+        try:
+            self._update_objects()
+        finally:
+            self._close_downloader()
         return
 
     def _fetch_data(self):
@@ -50,27 +56,26 @@ class UpdateStep(ImportStep):
 
         self.records = list()
         self.waiting_records = list()
-        self.sh = SoupHandler(self.domain_name)
+        self.sh = get_mapping_handler(self.domain_name)
+        # Objects modified from now on will be fetched by the next update
+        fetch_started = DateTime()
 
         # Dummy query to get overall number of items in the specified catalog
         query = {
             "url_or_endpoint": "search",
             "catalog": 'uid_catalog',
-            "recent_modified": utils.date_to_query_literal(self.fetch_time),
             "limit": 1
         }
+        query.update(utils.get_modified_query(self.fetch_time,
+                                              margin=FETCH_TIME_MARGIN))
         if self.full_sync_types:
             types = list()
             types.extend(self.full_sync_types + self.prefixable_types +
                          self.update_only_types + self.read_only_types)
             query["portal_type"] = types
+        query = self.get_listing_query(query)
         cd = self.get_json(**query)
 
-        # Knowing the catalog length compute the number of pages we will need
-        # with the desired window size and overlap
-        window = 500
-        overlap = 5
-        effective_window = window-overlap
         # When we receive an error message in JSON response or we
         # don't get any response at all the key 'count' doesn't exist.
         if not cd.get("count", None):
@@ -80,24 +85,18 @@ class UpdateStep(ImportStep):
             )
             return
 
-        number_of_pages = (cd["count"]/effective_window) + 1
         # Retrieve data from catalog in batches with size equal to window,
         # format it and insert it into the import soup
-        for current_page in xrange(number_of_pages):
-            start_from = (current_page * window) - overlap
-            query["limit"] = window
-            query["b_start"] = start_from
-            items = self.get_items_with_retry(**query)
-            if not items:
-                logger.error("CAN NOT GET ITEMS FROM {} TO {}".format(
-                    start_from, start_from + window))
-
+        for items in self.yield_pages(query, cd["count"], window=500,
+                                      overlap=5):
+            new_rows = []
             for item in items:
                 # skip object or extract the required data for the import
                 if not self.is_item_allowed(item):
                     continue
 
                 data_dict = utils.get_soup_format(item)
+                modified = item.get("modified")
                 existing_rec = self.sh.find_unique(
                     REMOTE_UID, data_dict[REMOTE_UID])
                 # If remote UID is in the souper table already, just check if
@@ -106,25 +105,41 @@ class UpdateStep(ImportStep):
                     rem_path = data_dict.get(REMOTE_PATH)
                     if rem_path != existing_rec.get(REMOTE_PATH):
                         self.sh.update_by_remote_uid(**data_dict)
-                    rec_id = existing_rec.get("rec_int_id")
-                else:
-                    rec_id = self.sh.insert(data_dict)
-                    # It is possible that insert failed because of non-unique
-                    # path value. We add this object to list and will insert
-                    # after updating path of 'duplicate' object
-                    if rec_id is False:
-                        self.waiting_records.append(data_dict)
+                    # Skip objects already updated with this version of data
+                    if modified and \
+                            modified == existing_rec.get(REMOTE_MODIFIED):
+                        continue
+                    # The modification date from the listing spares the
+                    # request of the object's data when the local object is
+                    # newer
+                    if modified and self._is_modified_locally(existing_rec,
+                                                              modified):
                         continue
+                    self.records.append(existing_rec.get(REC_ID))
+                else:
+                    new_rows.append(data_dict)
+
+            # Insert the new objects of the page at once. It is possible that
+            # insert failed because of non-unique path value. We add these
+            # objects to list and will insert after updating path of
+            # 'duplicate' objects
+            rec_ids = self.sh.bulk_insert(new_rows)
+            for data_dict, rec_id in zip(new_rows, rec_ids):
+                if rec_id is False:
+                    self.waiting_records.append(data_dict)
+                    continue
                 self.records.append(rec_id)
 
         # All path values were updated, there cannot be any repeating paths.
         # Time to insert waiting objects
-        for record in self.waiting_records:
-            rec_id = self.sh.insert(record)
+        rec_ids = self.sh.bulk_insert(self.waiting_records)
+        for rec_id in rec_ids:
+            if rec_id is False:
+                continue
             self.records.append(rec_id)
 
         storage = self.get_storage()
-        storage["last_fetch_time"] = DateTime()
+        storage["last_fetch_time"] = fetch_started
         logger.info("*** FETCH FINISHED. {} OBJECTS WILL BE UPDATED".format(
                                                         len(self.records)))
         return
@@ -136,8 +151,8 @@ class UpdateStep(ImportStep):
         """
         logger.info("*** IMPORT DATA STARTED: {} ***".format(self.domain_name))
 
-        self.sh = SoupHandler(self.domain_name)
-        self.uids_to_reindex = []
+        self.sh = get_mapping_handler(self.domain_name)
+        self.reindex_queue = ReindexQueue()
         total_object_count = len(self.records)
         start_time = datetime.now()
 
@@ -146,32 +161,23 @@ class UpdateStep(ImportStep):
             if not row:
                 continue
             logger.debug("Handling: {} ".format(row[REMOTE_PATH]))
-            self._handle_obj(row, handle_dependencies=False)
+            self._handle_obj(row)
 
             # Log.info every 50 objects imported
             utils.log_process(task_name="Update Step", started=start_time,
                               processed=item_index+1, total=total_object_count,
                               frequency=50)
 
-        self.uids_to_reindex = list(set(self.uids_to_reindex))
         logger.info("Reindexing {} objects...".format(
-                    len(self.uids_to_reindex)))
-        for uid in self.uids_to_reindex:
-            try:
-                obj = api.get_object_by_uid(uid)
-                obj.reindexObject()
-            except Exception, e:
-                rec = self.sh.find_unique(LOCAL_UID, uid)
-                logger.error("Error while reindexing {} - {}"
-                             .format(rec, e))
-        self.uids_to_reindex = []
+                    len(self.reindex_queue)))
+        self._flush_reindex_queue()
 
         # Mark all objects as non-updated for the next import.
         self.sh.reset_updated_flags()
         logger.info("*** IMPORT DATA FINISHED: {} ***".format(self.domain_name))
         return
 
-    def _handle_obj(self, row, handle_dependencies=False):
+    def _handle_obj(self, row, obj_data=None):
         """ Override super's method due to the following reasons:
             1.  No need to create object slugs, they are already created in
                 '_create_new_objects step.
@@ -181,16 +187,20 @@ class UpdateStep(ImportStep):
 
         :param row: A row dictionary from the souper
         :type row: dict
+        :param obj_data: complete data of the object if already fetched
+        :type obj_data: dict
         """
         r_uid = row.get(REMOTE_UID)
         try:
-            if row.get("updated", "0") == "1":
+            if self.sh.is_updated(row):
                 return True
             obj_path = row.get(LOCAL_PATH)
             obj = self.portal.unrestrictedTraverse(obj_path, None)
             time_modified = obj.modified()
-            obj_data = self.get_json(r_uid, complete=True,
-                                     workflow=True)
+
+            if obj_data is None:
+                obj_data = self.get_json(r_uid, complete=True,
+                                         workflow=True)
 
             rem_modified = DateTime(obj_data.get('modified'))
             if time_modified > rem_modified:
@@ -199,14 +209,38 @@ class UpdateStep(ImportStep):
                 return True
 
             self._update_object_with_data(obj, obj_data)
-
-            # In the end, we will restore the modification time
-            self.modification_dates[row[LOCAL_UID]] = time_modified
+            self.sh.mark_update(r_uid, **{
+                REMOTE_MODIFIED: obj_data.get("modified") or ""})
+
+            # Objects updated by Sync keep their modification time, otherwise
+            # source and destination would keep updating each other, since
+            # updates are based on 'modified' times. It is restored before the
+            # object is reindexed, so it is reindexed only once.
+            obj.setModificationDate(time_modified)
+            self.reindex_queue.add(api.get_uid(obj), keep_modified=True)
         except Exception, e:
             logger.error('Failed to handle {} : {} '.format(row, str(e)))
 
         return True
 
+    def _is_modified_locally(self, record, remote_modified):
+        """
+        Checks if the local object of the record was modified after its
+        remote object, so it must not be updated.
+        :param record: record of an existing object
+        :param remote_modified: modification date of the remote object
+        :return: True or False
+        """
+        obj_path = record.get(LOCAL_PATH)
+        obj = obj_path and self.portal.unrestrictedTraverse(obj_path, None)
+        if obj is None:
+            return False
+        if obj.modified() < DateTime(remote_modified):
+            return False
+        logger.info("'{}' has been modified in local and will not be "
+                    "updated".format(repr(obj)))
+        return True
+
     def _create_new_objects(self):
         """ Creates all the new objects from source without setting any
         field data. We use this to skip handling dependencies process. If any
@@ -216,7 +250,7 @@ class UpdateStep(ImportStep):
         """
         logger.info("*** CREATING NEW OBJECTS: {} ***".format(self.domain_name))
 
-        self.sh = SoupHandler(self.domain_name)
+        self.sh = get_mapping_handler(self.domain_name)
 
         for idx, rec_id in enumerate(self.records):
             row = self.sh.get_record_by_id(rec_id, as_dict=True)
@@ -231,21 +265,3 @@ class UpdateStep(ImportStep):
                 logger.info(" {} objects created.".format(idx))
         logger.info("***OBJ CREATION FINISHED: {} ***".format(self.domain_name))
         return
-
-    def restore_modification_dates(self):
-        """ When objects are updated by Sync, their 'modified' time should not
-        be updated. Otherwise, it can cause an infinite loop between source and
-        destination instances, since Update step based on 'modified' times.
-        It must be handled manually because reindexing object updates 'modified'
-        attribute.
-        https://docs.plone.org/4/en/develop/plone/content/manipulating.html
-        """
-        logger.info(" *** Restoring Old Modification Dates ***")
-
-        for uid, mod_time in self.modification_dates.iteritems():
-            obj = api.get_object_by_uid(uid)
-            obj.setModificationDate(mod_time)
-            obj.reindexObject(idxs=['modified'])
-
-        logger.info(" *** Modification Dates Restored ***")
-        return
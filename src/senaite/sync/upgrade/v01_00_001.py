@@ -12,6 +12,8 @@ from zope.annotation.interfaces import IAnnotations
 from bika.lims import api
 from bika.lims import logger
 from bika.lims.upgrade import upgradestep
+from senaite.sync.mappingstore import migrate_soup
+from senaite.sync.uidlist import UIDList
 
 version = '1.0.1'
 profile = 'profile-{senaite.sync}:default'
@@ -24,5 +26,25 @@ def upgrade(tool):
 
     # -------- ADD YOUR STUFF HERE --------
 
+    storage = annotation.get("senaite.sync")
+    if storage is not None:
+        for domain_name in storage.keys():
+            migrate_ordered_uids(storage[domain_name])
+            migrate_soup(portal, domain_name)
+
     return True
 
+
+def migrate_ordered_uids(domain_storage):
+    """ Replace the plain list of fetched UIDs by an UIDList. Items used to be
+    inserted at the beginning of the list, but are appended to the UIDList.
+    :param domain_storage: storage of a domain
+    :return:
+    """
+    ordered_uids = domain_storage.get("ordered_uids")
+    if not isinstance(ordered_uids, list):
+        return
+    logger.info("Migrating {} fetched UIDs...".format(len(ordered_uids)))
+    domain_storage["ordered_uids"] = UIDList(reversed(ordered_uids))
+    return
+
@@ -5,11 +5,13 @@
 # Copyright 2018 by it's authors.
 # Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
 
+import threading
+from collections import deque
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 
 from BTrees.OOBTree import OOBTree
 from DateTime import DateTime
-from Products.ATContentTypes.utils import DT2dt
 from senaite import api
 from senaite.sync import logger
 from senaite.sync.souphandler import REMOTE_UID, REMOTE_PATH, PORTAL_TYPE
@@ -20,9 +22,14 @@ SOUPER_REQUIRED_FIELDS = {"uid": REMOTE_UID,
                           "path": REMOTE_PATH,
                           "portal_type": PORTAL_TYPE}
 
+# Keys of the catalog listings' items the sync uses, the rest is dropped
+FETCH_METADATA = ("uid", "path", "portal_type", "parent_path", "parent_url",
+                  "modified")
+
 SYNC_CREDENTIALS = "senaite.sync.credentials"
 
-_default_date_format = "%Y-%m-%d"
+# Progress hook of the current thread, see set_progress_hook
+_progress = threading.local()
 
 
 def to_review_history_format(review_history):
@@ -118,6 +125,19 @@ def get_soup_format(item):
     return data_dict
 
 
+def get_metadata(item, keys=FETCH_METADATA):
+    """ From an item of a catalog listing return only the metadata the sync
+    uses, so the pages kept in memory are as small as possible.
+
+    :param item: dictionary with item data as obtained from the json API
+    :type item: dict
+    :param keys: keys to be kept
+    :return: dictionary with the given keys only
+    :rtype: dict
+    """
+    return dict([(key, item.get(key)) for key in keys if key in item])
+
+
 def is_review_history_imported(obj, review_history, wf_tool=None):
     """
     Check if review History info is already imported for given workflow.
@@ -149,6 +169,16 @@ def get_annotation(portal):
     return IAnnotations(portal)
 
 
+def set_progress_hook(hook):
+    """Set the function to be called by log_process in the current thread,
+    e.g. to report the progress of a background job
+    :param hook: function taking the task name, the datetime when it started,
+                 the number of processed items and the total number of items,
+                 or None to remove the current one
+    """
+    _progress.hook = hook
+
+
 def log_process(task_name, started, processed, total, frequency=1):
     """Logs the current status of the process
     :param task_name: name of the task
@@ -158,6 +188,10 @@ def log_process(task_name, started, processed, total, frequency=1):
     :param frequency: number of items to be processed before logging more
     :return:
     """
+    hook = getattr(_progress, "hook", None)
+    if hook is not None:
+        hook(task_name, started, processed, total)
+
     if frequency <= 0 or processed % frequency > 0 or total <= 0:
         return
 
@@ -190,34 +224,94 @@ def get_estimated_end_date(started, processed, total):
     return current_time + remaining_time
 
 
-def date_to_query_literal(date, date_format=_default_date_format):
-    """ Convert a date to a valid JSONAPI URL query string.
-    :param date: date to be converted in datetime, DateTime or string format
-    :param date_format: in case the date is string, format to parse it
-    :return string: literal date
+def get_modified_query(date, margin=0):
+    """ Get the request parameters to query the objects modified since the
+    given date. The date is passed as a ZPublisher record, so the catalog gets
+    the exact date instead of a relative one.
+    :param date: DateTime or string the objects must be modified since
+    :param margin: seconds subtracted from the date, to cover clock
+                   differences between both instances
+    :return: dictionary of request parameters
     """
     if not date:
-        return None
-
-    if isinstance(date, DateTime):
-        date = DT2dt(date)
-
-    if isinstance(date, basestring):
-        date = datetime.strptime(date, date_format)
+        return {}
+    date = DateTime(date) - margin / 86400.0
+    return {
+        "modified.query:record:date": date.ISO8601(),
+        "modified.range:record": "min",
+    }
+
+
+def ordered_parallel_map(func, iterable, workers=1, lookahead=None,
+                         initializer=None):
+    """Call a function for each element in a pool of threads and yield the
+    results in the same order as the elements.
+    Elements are taken from the iterable in the caller's thread, so the
+    iterable may access the database, but the function must not.
+    :param func: function to be called with each element
+    :param iterable: elements to be processed
+    :param workers: number of threads. If lower than 1, the function is
+                    called in the caller's thread
+    :param lookahead: maximum number of calls in flight or waiting to be
+                      consumed. Defaults to twice the number of workers
+    :param initializer: function to be called once in each worker thread
+    :return: generator of results
+    """
+    if workers < 1:
+        for element in iterable:
+            yield func(element)
+        return
 
-    days = (datetime.now() - date.replace(tzinfo=None)).days
+    if not lookahead:
+        lookahead = workers * 2
+    pool = ThreadPool(workers, initializer=initializer)
+    pending = deque()
+    try:
+        for element in iterable:
+            pending.append(pool.apply_async(func, (element, )))
+            if len(pending) >= lookahead:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        # Also reached when the consumer stops iterating or fails
+        pool.terminate()
+        pool.join()
+
+
+def chunks(iterable, size):
+    """Split an iterable into lists of consecutive elements
+    :param iterable: elements to be split
+    :param size: maximum number of elements per list
+    :return: generator of lists
+    """
+    chunk = []
+    for element in iterable:
+        chunk.append(element)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def get_uid_ranges(parts):
+    """Split the space of (hexadecimal) UIDs into contiguous ranges
+    :param parts: number of ranges, at most 256
+    :return: list of (lower, upper) tuples. None stands for an open bound
+    """
+    parts = max(1, min(parts, 256))
+    bounds = ["{:02x}".format(256 * i / parts) for i in range(1, parts)]
+    return zip([None] + bounds, bounds + [None])
 
-    if days < 1:
-        return "today"
-    if days < 2:
-        return "yesterday"
-    if days < 8:
-        return "this-week"
-    if days < 32:
-        return "this-month"
-    if days < 367:
-        return "this-year"
 
-    logger.warn("Interval is too long to be converted to string: {} days"
-                .format(days))
-    return ""
+def to_int(value, default=0):
+    """Convert the value to an integer
+    :param value: value to be converted, e.g. from a form
+    :param default: value to return if conversion fails
+    :return: integer
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default